@@ -10,65 +10,101 @@
 """
 Modules to compute gripper poses from contact masks and parameters.
 """
-import numpy as np
+import functools
+import math
+
 import torch
 import torch.nn.functional as F
-import trimesh.transformations as tra
 
 from grasp_gen.models.model_utils import MLP, repeat_new_axis
-from grasp_gen.robot import get_gripper_depth, get_gripper_info
+from grasp_gen.robot import get_gripper_info
+
+
+def _cat_objects(per_scene, width, like):
+    """Concatenates per-scene [num_objs, width] tensors, also for zero scenes."""
+    if len(per_scene) == 0:
+        return like.new_zeros(0, width)
+    return torch.cat(list(per_scene))
 
 
 def double_split(tensor, chunks):
-    tensor = list(tensor.split([sum(chunk) for chunk in chunks]))
-    tensor = [
-        list(elem.split([n for n in chunk])) for elem, chunk in zip(tensor, chunks)
-    ]
-    return tensor
+    # one split over all objects, regrouped into per-scene lists
+    parts = tensor.split([n for chunk in chunks for n in chunk])
+    out, start = [], 0
+    for chunk in chunks:
+        out.append(list(parts[start : start + len(chunk)]))
+        start += len(chunk)
+    return out
 
 
-def build_6d_grasp(
-    contact_pt, contact_dir, approach_dir, offset, gripper_name="franka_panda"
+@torch.jit.script
+def _build_6d_grasp(
+    contact_pt: torch.Tensor,
+    contact_dir: torch.Tensor,
+    approach_dir: torch.Tensor,
+    offset: torch.Tensor,
+    gripper_depth: float,
+    symmetric_antipodal: bool,
 ):
-
-    gripper_info = get_gripper_info(gripper_name)
-    gripper_depth = gripper_info.depth
-    grasp_translation = contact_pt - gripper_depth * approach_dir
-    if gripper_info.symmetric_antipodal:
-        # TODO: Make this a mask
-        grasp_translation += contact_dir * offset.unsqueeze(-1) / 2
-
-    grasp_tr = torch.stack(
-        [
-            contact_dir,
-            torch.cross(approach_dir, contact_dir),
-            approach_dir,
-            grasp_translation,
-        ],
-        axis=-1,
+    grasp_tr = torch.empty(
+        list(contact_pt.shape[:-1]) + [4, 4],
+        dtype=contact_pt.dtype,
+        device=contact_pt.device,
     )
-    last_row = torch.tensor([[0, 0, 0, 1]]).to(grasp_tr.device)
-    if len(grasp_tr.shape) > 2:
-        last_row = last_row * torch.ones(
-            *grasp_tr.shape[:-2], 1, 4, device=grasp_tr.device
+    grasp_tr[..., :3, 0] = contact_dir
+    grasp_tr[..., :3, 1] = torch.cross(approach_dir, contact_dir, dim=-1)
+    grasp_tr[..., :3, 2] = approach_dir
+    grasp_translation = torch.add(contact_pt, approach_dir, alpha=-gripper_depth)
+    if symmetric_antipodal:
+        # TODO: Make this a mask
+        grasp_translation = grasp_translation.addcmul(
+            contact_dir, offset.unsqueeze(-1), value=0.5
         )
-    grasp_tr = torch.cat([grasp_tr, last_row], dim=-2)
+    grasp_tr[..., :3, 3] = grasp_translation
+    grasp_tr[..., 3, :3] = 0.0
+    grasp_tr[..., 3, 3] = 1.0
     return grasp_tr
 
 
-def build_6d_place(contact_pts, rot, offset, ee_pose):
+@functools.lru_cache(maxsize=None)
+def _gripper_grasp_params(gripper_name):
+    # only the plain scalars are cached, GripperInfo itself holds meshes
+    gripper_info = get_gripper_info(gripper_name)
+    return float(gripper_info.depth), bool(gripper_info.symmetric)
+
+
+def build_6d_grasp(
+    contact_pt, contact_dir, approach_dir, offset, gripper_name="franka_panda"
+):
+    gripper_depth, symmetric_antipodal = _gripper_grasp_params(gripper_name)
+    return _build_6d_grasp(
+        contact_pt,
+        contact_dir,
+        approach_dir,
+        offset,
+        gripper_depth,
+        symmetric_antipodal,
+    )
+
+
+@torch.jit.script
+def build_6d_place(
+    contact_pts: torch.Tensor,
+    rot: torch.Tensor,
+    offset: torch.Tensor,
+    ee_pose: torch.Tensor,
+):
     # Transformation order: first rotate gripper to grasp pose,
     # then add offset between gripper center and reference point,
     # then rotate around object center, finally translate to contact point.
     rot = rot @ ee_pose[..., :3, :3]
-    trans = (contact_pts + offset).unsqueeze(-1)
-    place_tr = torch.cat([rot, trans], axis=-1)
-    last_row = torch.tensor([[0, 0, 0, 1]]).to(place_tr.device)
-    if len(place_tr.shape) > 2:
-        last_row = last_row * torch.ones(
-            *place_tr.shape[:-2], 1, 4, device=place_tr.device
-        )
-    place_tr = torch.cat([place_tr, last_row], dim=-2)
+    place_tr = torch.empty(
+        list(rot.shape[:-2]) + [4, 4], dtype=rot.dtype, device=rot.device
+    )
+    place_tr[..., :3, :3] = rot
+    place_tr[..., :3, 3] = contact_pts + offset
+    place_tr[..., 3, :3] = 0.0
+    place_tr[..., 3, 3] = 1.0
     return place_tr
 
 
@@ -80,9 +116,16 @@ def compute_offset(obj_pts, ee_pose, rot, grid_res=0, cam_pose=None):
         rot = cam_pose[:3, :3] @ rot
     obj_pts_stable = (obj_pts - ee_pose[:3, 3]) @ rot.transpose(-1, -2)
     if grid_res > 0:
-        obj_pts_grid = (obj_pts_stable[..., :2] / grid_res).round()
+        obj_pts_grid = (obj_pts_stable[..., :2] / grid_res).round().long()
         offset = obj_pts_stable.min(dim=0)[0]
-        offset[:2] = obj_pts_grid.unique(dim=0).mean(dim=0) * grid_res
+        # hash the occupied (x, y) cells into one int64 key so that unique runs
+        # on a flat tensor instead of doing a row-wise unique over dim 0
+        grid_min = obj_pts_grid.min(dim=0)[0]
+        obj_pts_grid = obj_pts_grid - grid_min
+        width = obj_pts_grid[:, 1].max() + 1
+        cells = torch.unique(obj_pts_grid[:, 0] * width + obj_pts_grid[:, 1])
+        cells = torch.stack([cells // width, cells % width], dim=-1) + grid_min
+        offset[:2] = cells.to(offset.dtype).mean(dim=0) * grid_res
     else:
         offset = obj_pts_stable.mean(dim=0)
         offset[..., 2] = obj_pts_stable[..., 2].min(dim=1)[0]
@@ -92,20 +135,47 @@ def compute_offset(obj_pts, ee_pose, rot, grid_res=0, cam_pose=None):
     return offset
 
 
+_ROT_Z_PROMPTS = {}
+
+
+def rot_z_prompts(num_rot, device, dtype=torch.float32):
+    """Rotations about the z-axis evenly spaced in [0, 2pi), cached per device.
+
+    Returns:
+        torch.Tensor: [num_rot, 3, 3] rotation matrices.
+    """
+    key = (num_rot, torch.device(device), dtype)
+    if key not in _ROT_Z_PROMPTS:
+        theta = torch.arange(num_rot, device=device, dtype=torch.float64)
+        theta = theta * (2 * math.pi / num_rot)
+        cos, sin = theta.cos(), theta.sin()
+        zeros, ones = torch.zeros_like(theta), torch.ones_like(theta)
+        rot = torch.stack(
+            [cos, -sin, zeros, sin, cos, zeros, zeros, zeros, ones], dim=-1
+        )
+        _ROT_Z_PROMPTS[key] = rot.view(num_rot, 3, 3).to(dtype)
+    return _ROT_Z_PROMPTS[key]
+
+
 def infer_placements(
     xyz, logits, bottom_center, ee_poses, cam_poses, conf_thresh, height
 ):
-    rot_prompts = torch.stack(
-        [
-            torch.from_numpy(tra.euler_matrix(0, 0, 2 * np.pi / logits.shape[1] * i))[
-                :3, :3
-            ].float()
-            for i in range(logits.shape[1])
-        ]
-    ).to(xyz.device)
+    rot_prompts = rot_z_prompts(logits.shape[1], xyz.device, xyz.dtype)
     rot_prompts = repeat_new_axis(rot_prompts, xyz.shape[1], dim=1)
+    # R @ p + t for every point in one batched gemm with the bias fused in,
+    # done before repeating the points for every rotation prompt
+    xyz_world = torch.baddbmm(
+        cam_poses[:, :3, 3].unsqueeze(1), xyz, cam_poses[:, :3, :3].transpose(1, 2)
+    )
     xyz = repeat_new_axis(xyz, logits.shape[1], dim=1)
-    xyz_world = xyz @ cam_poses[:, :3, :3].transpose(1, 2) + cam_poses[:, :3, 3]
+    xyz_world = repeat_new_axis(xyz_world, logits.shape[1], dim=1)
+    # camera poses are rigid, so invert all of them at once as [R^T | -R^T t]
+    # instead of running a general inverse per batch element inside the loop
+    rot_inv = cam_poses[:, :3, :3].transpose(1, 2)
+    cam_inv = torch.zeros_like(cam_poses)
+    cam_inv[:, :3, :3] = rot_inv
+    cam_inv[:, :3, 3] = -torch.bmm(rot_inv, cam_poses[:, :3, 3:]).squeeze(-1)
+    cam_inv[:, 3, 3] = 1
 
     placements, confidence, contact_points = [], [], []
     for i, (bc, ee_pose, logit) in enumerate(zip(bottom_center, ee_poses, logits)):
@@ -117,8 +187,7 @@ def infer_placements(
         contacts = xyz_world[i][mask]
         place = build_6d_place(contacts, rot, offsets, ee_pose)
         place[:, 2, 3] = place[:, 2, 3] + height
-        if cam_poses is not None:
-            place = cam_poses[i].inverse() @ place
+        place = cam_inv[i] @ place
         placements.append(list(place.split(num)))
         confidence.append(list(conf[mask].split(num)))
         contact_points.append(list(xyz[i][mask].split(num)))
@@ -143,6 +212,9 @@ class ActionDecoder(torch.nn.Module):
         offset_bins,
         gripper_depth,
         gripper_name,
+        use_bf16=False,
+        grasp_depth=None,
+        symmetric_antipodal=None,
     ):
         super(ActionDecoder, self).__init__()
         feat_dim = mask_dim
@@ -156,10 +228,19 @@ class ActionDecoder(torch.nn.Module):
             feat_dim, hidden_dim, len(offset_bins) - 1, num_layers, activation
         )
         offset_bins = torch.tensor(offset_bins).float()
-        self.offset_vals = (offset_bins[:-1] + offset_bins[1:]) / 2
+        self.register_buffer(
+            "offset_vals", (offset_bins[:-1] + offset_bins[1:]) / 2, persistent=False
+        )
         self.max_num_pred = max_num_pred
         self.gripper_depth = gripper_depth
         self.gripper_name = gripper_name
+        # resolved once here instead of looking the gripper up every forward,
+        # from_config passes them in from the gripper info it already loads
+        if grasp_depth is None or symmetric_antipodal is None:
+            grasp_depth, symmetric_antipodal = _gripper_grasp_params(gripper_name)
+        self._grasp_depth = float(grasp_depth)
+        self._symmetric_antipodal = bool(symmetric_antipodal)
+        self.use_bf16 = use_bf16
 
     @classmethod
     def from_config(cls, cfg, contact_decoder):
@@ -171,10 +252,13 @@ class ActionDecoder(torch.nn.Module):
         args["hidden_dim"] = cfg.hidden_dim
         args["num_layers"] = cfg.num_layers
         args["activation"] = cfg.activation
-        offset_bins, _ = get_gripper_offset_bins(cfg.gripper_name)
-        args["offset_bins"] = offset_bins
+        gripper_info = get_gripper_info(cfg.gripper_name)
+        args["offset_bins"] = gripper_info.offset_bins
         args["gripper_depth"] = cfg.gripper_depth
         args["gripper_name"] = cfg.gripper_name
+        args["use_bf16"] = cfg.get("use_bf16", False)
+        args["grasp_depth"] = gripper_info.depth
+        args["symmetric_antipodal"] = gripper_info.symmetric
         return cls(**args)
 
     def forward(
@@ -184,68 +268,84 @@ class ActionDecoder(torch.nn.Module):
             assert xyz.shape[1] == 1
             xyz = xyz.squeeze(1)
         mask_feats = mask_feats.moveaxis(1, -1)  # [B, H, W, mask_dim]
-        contacts, conf_all, inputs, num_grasps = [], [], [], []
-        total_grasps, num_objs = 0, 0
-        for i, (pts, feat, emb, conf_scene) in enumerate(
-            zip(xyz, mask_feats, embedding, confidence)
-        ):
-            masks = conf_scene > mask_thresh
-            if gt_masks is not None:
-                masks = masks | (gt_masks[i] > 0)
-            conf_list, num = [], []
-            for e, m, conf in zip(emb, masks, conf_scene):
-                f, p, c = feat[m], pts[m], conf[m]
-
-                if self.max_num_pred is not None:
-                    perm = torch.randperm(f.shape[0])[: self.max_num_pred]
-                    perm = perm.to(f.device)
-                    f, p, c = f[perm], p[perm], c[perm]
-                if self.use_embed:
-                    f = torch.cat([f, repeat_new_axis(e, f.shape[0], dim=0)], dim=-1)
-                contacts.append(p)
-                inputs.append(f)
-                conf_list.append(c)
-                num.append(f.shape[0])
-                total_grasps += f.shape[0]
-            conf_all.append(conf_list)
-            num_grasps.append(num)
-            num_objs += len(conf_list)
-        if total_grasps > 0:
-            contacts = torch.cat(contacts)
-            inputs = torch.cat(inputs)
-        else:
-            contacts = torch.zeros(0, 3).to(xyz.device)
-            inputs = torch.zeros(0, self.feat_dim).to(xyz.device)
 
+        # Flatten the per-scene object masks into a single [num_objs, HW] tensor
+        # so that all contacts can be gathered with one indexing op.
+        objs_per_scene = [conf_scene.shape[0] for conf_scene in confidence]
+        num_objs = sum(objs_per_scene)
+        conf_flat = _cat_objects(confidence, xyz.shape[1], xyz)
+        masks = conf_flat > mask_thresh
         if gt_masks is not None:
-            if self.use_embed:
-                embed = torch.stack(
-                    [emb.T @ mask for emb, mask in zip(embedding, gt_masks)]
-                ).transpose(1, 2)
-                mask_feats = torch.cat([mask_feats, embed], dim=-1)
-            gt_inputs = torch.cat(
-                [
-                    feat[(mask > 0).any(dim=0)]
-                    for feat, mask in zip(mask_feats, gt_masks)
-                ]
+            masks = masks | (_cat_objects(gt_masks, xyz.shape[1], xyz) > 0)
+        scene_ids = torch.arange(len(objs_per_scene), device=masks.device)
+        scene_ids = scene_ids.repeat_interleave(
+            torch.tensor(objs_per_scene, dtype=torch.long, device=masks.device)
+        )
+
+        if self.max_num_pred is not None and self.max_num_pred < masks.shape[-1]:
+            # Randomly keep at most max_num_pred contacts per object with one
+            # top-k over random scores, masked out points always score lowest.
+            scores = torch.rand(masks.shape, device=masks.device)
+            scores.masked_fill_(~masks, -1)
+            keep = scores.topk(self.max_num_pred, dim=-1)
+            masks = torch.zeros_like(masks).scatter_(
+                -1, keep.indices, keep.values >= 0
             )
+        obj_ids, pt_ids = torch.nonzero(masks, as_tuple=True)
+        counts = masks.sum(dim=-1)
+
+        batch_ids = scene_ids[obj_ids]
+        contacts = xyz[batch_ids, pt_ids]
+        inputs = mask_feats[batch_ids, pt_ids]
+        conf = conf_flat[obj_ids, pt_ids]
+        if self.use_embed:
+            embed_dim = self.feat_dim - mask_feats.shape[-1]
+            embed_flat = _cat_objects(embedding, embed_dim, mask_feats)
+            inputs = torch.cat([inputs, embed_flat[obj_ids]], dim=-1)
+
+        num_pred_grasps = counts.sum() / max(num_objs, 1)
+        counts = counts.tolist()
+        total_grasps = sum(counts)
+        num_grasps, start = [], 0
+        for n in objs_per_scene:
+            num_grasps.append(counts[start : start + n])
+            start += n
+        conf_all = double_split(conf, num_grasps)
+
+        if gt_masks is not None:
+            gt_sel = torch.stack([(mask > 0).any(dim=0) for mask in gt_masks])
+            gt_inputs = mask_feats[gt_sel]
+            if self.use_embed:
+                # Object embeddings are only needed at the selected points, so
+                # they are computed and concatenated on the gathered rows only.
+                gt_embed = torch.cat(
+                    [
+                        mask[:, sel].T @ emb
+                        for emb, mask, sel in zip(embedding, gt_masks, gt_sel)
+                    ]
+                )
+                gt_inputs = torch.cat([gt_inputs, gt_embed], dim=-1)
             total_gt_grasps = gt_inputs.shape[0]
+            num_gt_grasps = gt_sel.sum() / max(num_objs, 1)
             inputs = torch.cat([inputs, gt_inputs])
 
-        contact_dirs = F.normalize(self.contact_dir_head(inputs), dim=-1)
-        approach_dirs = self.approach_dir_head(inputs)
+        # Only the MLP heads run in bf16, normalization and the grasp geometry
+        # below stay in fp32.
+        with torch.autocast(
+            "cuda", dtype=torch.bfloat16, enabled=self.use_bf16 and inputs.is_cuda
+        ):
+            contact_dirs = self.contact_dir_head(inputs)
+            approach_dirs = self.approach_dir_head(inputs)
+            offset_logits = self.offset_head(inputs)
+        contact_dirs = F.normalize(contact_dirs.float(), dim=-1)
+        approach_dirs = approach_dirs.float()
+        offset_logits = offset_logits.float()
+        # Gram-Schmidt: remove the contact direction component from the approach
+        dot = torch.einsum("nc,nc->n", approach_dirs, contact_dirs).unsqueeze(-1)
         approach_dirs = F.normalize(
-            approach_dirs
-            - contact_dirs * (approach_dirs * contact_dirs).sum(dim=-1, keepdim=True),
-            dim=-1,
+            approach_dirs.addcmul(contact_dirs, dot, value=-1), dim=-1
         )
-        offset_logits = self.offset_head(inputs)
-        offsets_one_hot = F.one_hot(
-            offset_logits.argmax(dim=-1), self.offset_vals.shape[0]
-        )
-        offsets = (
-            offsets_one_hot.float() @ self.offset_vals.to(inputs.device)
-        ).squeeze(-1)
+        offsets = self.offset_vals[offset_logits.argmax(dim=-1)]
 
         outputs = {}
         if gt_masks is not None:
@@ -258,13 +358,13 @@ class ActionDecoder(torch.nn.Module):
             offsets = offsets[:total_grasps]
             outputs["offsets"] = offset_logits[total_grasps:]
 
-        grasps = build_6d_grasp(
+        grasps = _build_6d_grasp(
             contacts,
             contact_dirs,
             approach_dirs,
             offsets,
-            gripper_depth=get_gripper_depth(self.gripper_name),
-            gripper_name=self.gripper_name,
+            self._grasp_depth,
+            self._symmetric_antipodal,
         )
         grasps = double_split(grasps, num_grasps)
         contacts = double_split(contacts, num_grasps)
@@ -273,13 +373,9 @@ class ActionDecoder(torch.nn.Module):
                 "grasps": grasps,
                 "grasp_confidence": conf_all,
                 "grasp_contacts": contacts,
-                "num_pred_grasps": torch.tensor(
-                    total_grasps / max(num_objs, 1), device=inputs.device
-                ),
+                "num_pred_grasps": num_pred_grasps,
             }
         )
         if gt_masks is not None:
-            outputs["num_gt_grasps"] = torch.tensor(
-                total_gt_grasps / max(num_objs, 1), device=inputs.device
-            )
+            outputs["num_gt_grasps"] = num_gt_grasps
         return outputs
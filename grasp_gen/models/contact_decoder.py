@@ -24,37 +24,37 @@ from grasp_gen.models.model_utils import (
     PositionEncoding3D,
     PositionEncodingOld3D,
     get_activation_fn,
-    repeat_new_axis,
 )
 
 
-def compute_attention_mask(attn_mask, nn_ids, context_size, num_heads):
+def compute_attention_mask(attn_mask, nn_ids, context_size):
+    # If a BoolTensor is provided as attention mask,
+    # positions with ``True`` are not allowed to attend.
+    # attn_mask comes in as a BxQxM bool tensor that is True where the
+    # predicted mask logits < 0, i.e. where attention is blocked.
     # resize attention mask to the size of context features
     if nn_ids is None:
-        attn_mask = F.interpolate(attn_mask, context_size)
+        # nearest neighbor resize, same indexing as F.interpolate(mode="nearest")
+        M = attn_mask.shape[-1]
+        idx = torch.arange(context_size, device=attn_mask.device) * (M / context_size)
+        idx = idx.long().clamp_(max=M - 1)
+        attn_mask = attn_mask.index_select(-1, idx)
     else:
         j = 0
         while attn_mask.shape[-1] != context_size:
-            # BxQxM -> BxQxMxK
-            attn_mask = repeat_new_axis(attn_mask, nn_ids[j].shape[-1], dim=3)
-            # BxNxK -> BxQxNxK
-            idx = repeat_new_axis(nn_ids[j], attn_mask.shape[1], dim=1)
-            # BxQxMxK -> BxQxNxK
-            attn_mask = torch.gather(attn_mask, dim=-2, index=idx.long())
-            # BxQxNxK -> BxQxN
-            attn_mask = attn_mask.max(dim=-1)[0]
+            B, N, K = nn_ids[j].shape
+            # BxNxK -> Bx1xNK -> BxQxNK (expanded view, no copy)
+            idx = nn_ids[j].flatten(start_dim=1).unsqueeze(1)
+            idx = idx.expand(-1, attn_mask.shape[1], -1)
+            # BxQxM -> BxQxNK -> BxQxNxK -> BxQxN
+            attn_mask = torch.gather(attn_mask, dim=-1, index=idx)
+            # max of the neighbor logits is < 0 iff all of them are < 0
+            attn_mask = attn_mask.view(B, -1, N, K).all(dim=-1)
             j += 1
-    # If a BoolTensor is provided as attention mask,
-    # positions with ``True`` are not allowed to attend.
-    # We block attention where predicted mask logits < 0.
-    attn_mask = (attn_mask < 0).bool()
-    # [B, Q, N] -> [B, h, Q, N] -> [B*h, Q, N]
-    attn_mask = repeat_new_axis(attn_mask, num_heads, dim=1).flatten(
-        start_dim=0, end_dim=1
-    )
     # If attn mask is empty for any query, allow attention anywhere.
-    attn_mask[torch.where(attn_mask.sum(-1) == attn_mask.shape[-1])] = False
-    return attn_mask
+    # The [B, Q, N] mask is broadcast over heads inside the attention layer
+    # rather than materialized per head.
+    return attn_mask & ~attn_mask.all(dim=-1, keepdim=True)
 
 
 class ContactDecoder(nn.Module):
@@ -76,6 +76,7 @@ class ContactDecoder(nn.Module):
         use_task_embed: bool,
         activation: str,
         pos_enc: str,
+        use_bf16: bool = False,
     ):
         """
         Args:
@@ -89,11 +90,14 @@ class ContactDecoder(nn.Module):
             num_queries: number of object queries
             use_attn_mask: mask attention with downsampled instance mask
                            predicted by the previous layer
+            use_bf16: run the decoder under bf16 autocast on CUDA, outputs
+                      are cast back to fp32
         """
         super(ContactDecoder, self).__init__()
 
         self.num_grasp_queries = num_grasp_queries
         self.num_place_queries = num_place_queries
+        self.use_bf16 = use_bf16
         # learnable grasp query features
         self.query_embed = nn.Embedding(
             num_grasp_queries + num_place_queries, embed_dim
@@ -117,13 +121,14 @@ class ContactDecoder(nn.Module):
         self.scene_feature_proj = nn.ModuleList(
             [
                 (
-                    nn.Conv2d(channel, embed_dim, kernel_size=1)
+                    nn.Linear(channel, embed_dim)
                     if channel != embed_dim
                     else nn.Identity()
                 )
                 for channel in scene_in_channels
             ]
         )
+        self._register_load_state_dict_pre_hook(self._load_conv_feature_proj)
         # context positional encoding
         if pos_enc == "old":
             self.pe_layer = PositionEncodingOld3D(embed_dim)
@@ -163,6 +168,14 @@ class ContactDecoder(nn.Module):
         if use_task_embed:
             # learnable task embedding
             self.task_embed = nn.Embedding(num_tasks, embed_dim)
+        # pick the prediction path once so that single-task models skip the
+        # query split and the mask concatenation at every decoder layer
+        if num_place_queries == 0:
+            self.predict_mode = "grasp"
+        elif num_grasp_queries == 0:
+            self.predict_mode = "place"
+        else:
+            self.predict_mode = "both"
 
     @classmethod
     def from_config(cls, cfg, scene_channels, obj_channels):
@@ -186,8 +199,24 @@ class ContactDecoder(nn.Module):
         args["use_task_embed"] = cfg.use_task_embed
         args["activation"] = cfg.activation
         args["pos_enc"] = cfg.pos_enc
+        args["use_bf16"] = cfg.get("use_bf16", False)
         return cls(**args)
 
+    def predict_grasp(self, embed, mask_features):
+        embed = {"grasp": self.norm(embed).transpose(0, 1)}
+        pred = {"objectness": self.object_head(embed["grasp"]).squeeze(-1)}
+        emb = self.grasp_mask_head(embed["grasp"])
+        # [B, Q, C] @ [B, C, N] -> [B, Q, N]
+        pred["grasping_masks"] = torch.matmul(emb, mask_features)
+        # We block attention where predicted mask logits < 0.
+        return pred, embed, pred["grasping_masks"] < 0
+
+    def predict_place(self, embed, mask_features):
+        embed = {"place": self.norm(embed).transpose(0, 1)}
+        emb = self.place_mask_head(embed["place"])
+        pred = {"placement_masks": torch.matmul(emb, mask_features)}
+        return pred, embed, pred["placement_masks"] < 0
+
     def predict(self, embed, mask_features):
         embed = self.norm(embed)
         grasp_embed, place_embed = embed.split(
@@ -198,16 +227,35 @@ class ContactDecoder(nn.Module):
             embed["grasp"] = grasp_embed.transpose(0, 1)
             pred["objectness"] = self.object_head(embed["grasp"]).squeeze(-1)
             emb = self.grasp_mask_head(embed["grasp"])
-            pred["grasping_masks"] = torch.einsum("bqc,bcn->bqn", emb, mask_features)
+            # [B, Q, C] @ [B, C, N] -> [B, Q, N]
+            pred["grasping_masks"] = torch.matmul(emb, mask_features)
             attn_mask.append(pred["grasping_masks"])
         if place_embed.shape[0] > 0:
             embed["place"] = place_embed.transpose(0, 1)
             emb = self.place_mask_head(embed["place"])
-            pred["placement_masks"] = torch.einsum("bqc,bcn->bqn", emb, mask_features)
+            pred["placement_masks"] = torch.matmul(emb, mask_features)
             attn_mask.append(pred["placement_masks"])
-        attn_mask = torch.cat(attn_mask, dim=1).detach()
+        # We block attention where predicted mask logits < 0.
+        attn_mask = torch.cat(attn_mask, dim=1) < 0
         return pred, embed, attn_mask
 
+    def _predict(self, embed, mask_features):
+        if self.predict_mode == "grasp":
+            return self.predict_grasp(embed, mask_features)
+        if self.predict_mode == "place":
+            return self.predict_place(embed, mask_features)
+        return self.predict(embed, mask_features)
+
+    @staticmethod
+    def _load_conv_feature_proj(state_dict, prefix, *args):
+        # scene_feature_proj used to be 1x1 Conv2d, squeeze old checkpoints
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix + "scene_feature_proj.") and key.endswith(
+                ".weight"
+            ):
+                if state_dict[key].dim() == 4:
+                    state_dict[key] = state_dict[key].flatten(1)
+
     def construct_context(self, features, feature_keys, feature_proj):
         context = [features["features"][f] for f in feature_keys]
         pos_encs, context_sizes = [], []
@@ -216,12 +264,11 @@ class ContactDecoder(nn.Module):
             context_sizes.append(context[i].shape[-1])
             pos_enc = pos_enc.flatten(start_dim=2).permute(2, 0, 1)
             pos_encs.append(pos_enc)
-            context[i] = feature_proj[i](context[i].unsqueeze(-1)).squeeze(
-                -1
-            )  # Project different dim PointNet++ features to embed_dim
-            context[i] = context[i] + self.scale_embed.weight[i].unsqueeze(1)
-            # NxCxHW -> HWxNxC
-            context[i] = context[i].permute(2, 0, 1)
+            # Project different dim PointNet++ features to embed_dim
+            context[i] = feature_proj[i](context[i].transpose(1, 2))
+            context[i] = context[i] + self.scale_embed.weight[i]
+            # NxHWxC -> HWxNxC
+            context[i] = context[i].permute(1, 0, 2)
         return context, pos_encs, context_sizes
 
     def forward(self, scene_features, obj_features):
@@ -232,10 +279,22 @@ class ContactDecoder(nn.Module):
             obj_features: a dict containing multi-scale feature maps
                           from point cloud of object to be placed
         """
+        mask_feat = scene_features["features"][self.mask_feature]
+        if not (self.use_bf16 and mask_feat.is_cuda):
+            return self._forward(scene_features, obj_features)
+        with torch.autocast("cuda", dtype=torch.bfloat16):
+            embedding, predictions = self._forward(scene_features, obj_features)
+        embedding = {k: v.float() for k, v in embedding.items()}
+        predictions = [{k: v.float() for k, v in p.items()} for p in predictions]
+        return embedding, predictions
+
+    def _forward(self, scene_features, obj_features):
         context, pos_encs, context_sizes = self.construct_context(
             scene_features, self.scene_in_features, self.scene_feature_proj
         )
         mask_feat = scene_features["features"][self.mask_feature]
+        # neighbor ids are shared by every decoder layer, cast them only once
+        nn_ids = [idx.long() for idx in scene_features["sample_ids"]]
 
         grasp_embed, place_embed = self.query_embed.weight.split(
             [self.num_grasp_queries, self.num_place_queries]
@@ -244,7 +303,7 @@ class ContactDecoder(nn.Module):
         if grasp_embed.shape[0] > 0:
             if self.use_task_embed:
                 grasp_embed = grasp_embed + self.task_embed.weight[task_id]
-            embed.append(repeat_new_axis(grasp_embed, mask_feat.shape[0], dim=1))
+            embed.append(grasp_embed.unsqueeze(1).expand(-1, mask_feat.shape[0], -1))
             task_id += 1
         if place_embed.shape[0] > 0:
             place_prompts = obj_features["features"][self.place_feature]
@@ -255,12 +314,14 @@ class ContactDecoder(nn.Module):
             embed.append(place_embed.unsqueeze(1) + place_prompts.unsqueeze(0))
 
         embed = torch.cat(embed)
-        query_pos_enc = repeat_new_axis(
-            self.query_pos_enc.weight, mask_feat.shape[0], dim=1
+        # QxC -> QxBxC, an expanded view is enough since it is only ever
+        # added to the (contiguous) query features
+        query_pos_enc = self.query_pos_enc.weight.unsqueeze(1).expand(
+            -1, mask_feat.shape[0], -1
         )
 
         # initial prediction with learnable query features only (no context)
-        prediction, _, attn_mask = self.predict(embed, mask_feat)
+        prediction, _, attn_mask = self._predict(embed, mask_feat)
         predictions = [prediction]
 
         for i in range(self.num_layers):
@@ -269,9 +330,8 @@ class ContactDecoder(nn.Module):
             if self.use_attn_mask:
                 attn_mask = compute_attention_mask(
                     attn_mask,
-                    scene_features["sample_ids"],
+                    nn_ids,
                     context_sizes[j],
-                    self.num_heads,
                 )
             else:
                 attn_mask = None
@@ -290,6 +350,6 @@ class ContactDecoder(nn.Module):
             )
             embed = self.ffn_layers[i](embed)
 
-            prediction, embedding, attn_mask = self.predict(embed, mask_feat)
+            prediction, embedding, attn_mask = self._predict(embed, mask_feat)
             predictions.append(prediction)
         return embedding, predictions
@@ -0,0 +1,195 @@
+# Copyright (c) 2025, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+"""
+Triton LayerNorm kernels for inference of the ViT blocks.
+"""
+import torch
+import torch.nn as nn
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+# rows up to this width are normalized from a single register tile, wider rows
+# are reduced tile by tile with a Welford merge
+_MAX_TILE = 4096
+
+
+if triton is not None:
+
+    @triton.jit
+    def _layer_norm_fwd_tile(X, Y, W, B, N, eps, BLOCK_SIZE: tl.constexpr):
+        row = tl.program_id(0)
+        X += row * N
+        Y += row * N
+        cols = tl.arange(0, BLOCK_SIZE)
+        mask = cols < N
+        x = tl.load(X + cols, mask=mask, other=0.0).to(tl.float32)
+        mean = tl.sum(x, axis=0) / N
+        xc = tl.where(mask, x - mean, 0.0)
+        inv_std = tl.rsqrt(tl.sum(xc * xc, axis=0) / N + eps)
+        w = tl.load(W + cols, mask=mask).to(tl.float32)
+        b = tl.load(B + cols, mask=mask).to(tl.float32)
+        y = xc * inv_std * w + b
+        tl.store(Y + cols, y.to(Y.dtype.element_ty), mask=mask)
+
+    @triton.jit
+    def _add_layer_norm_fwd_tile(
+        X, R, S, Y, W, B, N, eps, BLOCK_SIZE: tl.constexpr
+    ):
+        # S = X + R and Y = LayerNorm(S), the sum is normalized straight from
+        # registers instead of being read back from memory
+        row = tl.program_id(0)
+        X += row * N
+        R += row * N
+        S += row * N
+        Y += row * N
+        cols = tl.arange(0, BLOCK_SIZE)
+        mask = cols < N
+        x = tl.load(X + cols, mask=mask, other=0.0).to(tl.float32)
+        x += tl.load(R + cols, mask=mask, other=0.0).to(tl.float32)
+        tl.store(S + cols, x.to(S.dtype.element_ty), mask=mask)
+        mean = tl.sum(x, axis=0) / N
+        xc = tl.where(mask, x - mean, 0.0)
+        inv_std = tl.rsqrt(tl.sum(xc * xc, axis=0) / N + eps)
+        w = tl.load(W + cols, mask=mask).to(tl.float32)
+        b = tl.load(B + cols, mask=mask).to(tl.float32)
+        y = xc * inv_std * w + b
+        tl.store(Y + cols, y.to(Y.dtype.element_ty), mask=mask)
+
+    @triton.jit
+    def _layer_norm_fwd_welford(X, Y, W, B, N, eps, BLOCK_SIZE: tl.constexpr):
+        row = tl.program_id(0)
+        X += row * N
+        Y += row * N
+        mean = 0.0
+        m2 = 0.0
+        count = 0.0
+        for off in range(0, N, BLOCK_SIZE):
+            cols = off + tl.arange(0, BLOCK_SIZE)
+            mask = cols < N
+            x = tl.load(X + cols, mask=mask, other=0.0).to(tl.float32)
+            n_b = tl.sum(mask.to(tl.float32), axis=0)
+            mean_b = tl.sum(x, axis=0) / n_b
+            xc = tl.where(mask, x - mean_b, 0.0)
+            m2_b = tl.sum(xc * xc, axis=0)
+            total = count + n_b
+            delta = mean_b - mean
+            mean += delta * n_b / total
+            m2 += m2_b + delta * delta * count * n_b / total
+            count = total
+        inv_std = tl.rsqrt(m2 / N + eps)
+        for off in range(0, N, BLOCK_SIZE):
+            cols = off + tl.arange(0, BLOCK_SIZE)
+            mask = cols < N
+            x = tl.load(X + cols, mask=mask, other=0.0).to(tl.float32)
+            w = tl.load(W + cols, mask=mask).to(tl.float32)
+            b = tl.load(B + cols, mask=mask).to(tl.float32)
+            y = (x - mean) * inv_std * w + b
+            tl.store(Y + cols, y.to(Y.dtype.element_ty), mask=mask)
+
+
+def layer_norm(x, weight, bias, eps=1e-5):
+    """LayerNorm over the last dim of a CUDA tensor with one program per row.
+
+    Forward only, there is no backward kernel.
+    """
+    shape = x.shape
+    N = shape[-1]
+    x = x.reshape(-1, N).contiguous()
+    y = torch.empty_like(x)
+    if N <= _MAX_TILE:
+        block_size = triton.next_power_of_2(N)
+        kernel = _layer_norm_fwd_tile
+    else:
+        block_size = _MAX_TILE
+        kernel = _layer_norm_fwd_welford
+    num_warps = min(max(block_size // 256, 1), 8)
+    kernel[(x.shape[0],)](
+        x, y, weight, bias, N, eps, BLOCK_SIZE=block_size, num_warps=num_warps
+    )
+    return y.view(shape)
+
+
+def add_layer_norm(x, residual, weight, bias, eps=1e-5):
+    """Returns (x + residual, LayerNorm(x + residual)) from a single kernel.
+
+    Forward only and limited to rows of at most 4096 elements.
+    """
+    shape = x.shape
+    N = shape[-1]
+    assert N <= _MAX_TILE, f"add_layer_norm supports rows of at most {_MAX_TILE}"
+    x = x.reshape(-1, N).contiguous()
+    residual = residual.reshape(-1, N).contiguous()
+    out = torch.empty_like(x)
+    y = torch.empty_like(x)
+    block_size = triton.next_power_of_2(N)
+    _add_layer_norm_fwd_tile[(x.shape[0],)](
+        x,
+        residual,
+        out,
+        y,
+        weight,
+        bias,
+        N,
+        eps,
+        BLOCK_SIZE=block_size,
+        num_warps=min(max(block_size // 256, 1), 8),
+    )
+    return out.view(shape), y.view(shape)
+
+
+def can_fuse_add_layer_norm(x, residual, norm):
+    """Whether fused_add_layer_norm(x, residual, norm) runs the Triton kernel."""
+    return (
+        isinstance(norm, FusedLayerNorm)
+        and norm._use_kernel(x)
+        and x.shape[-1] <= _MAX_TILE
+        and residual.dtype == x.dtype
+        and not (torch.is_grad_enabled() and residual.requires_grad)
+    )
+
+
+def fused_add_layer_norm(x, residual, norm):
+    """Adds x to the residual stream and applies norm to the sum.
+
+    Returns the new residual and the normalized tensor. Both are fresh tensors,
+    the inputs are left untouched.
+    """
+    if can_fuse_add_layer_norm(x, residual, norm):
+        return add_layer_norm(x, residual, norm.weight, norm.bias, norm.eps)
+    residual = residual + x
+    return residual, norm(residual)
+
+
+class FusedLayerNorm(nn.LayerNorm):
+    """nn.LayerNorm that runs the Triton kernel for CUDA inference.
+
+    Training, autocast regions and CPU inputs use the regular implementation.
+    """
+
+    def _use_kernel(self, x):
+        return not (
+            triton is None
+            or not x.is_cuda
+            or self.weight is None
+            or self.bias is None
+            or len(self.normalized_shape) != 1
+            or torch.is_autocast_enabled()
+            or (
+                torch.is_grad_enabled()
+                and (x.requires_grad or self.weight.requires_grad)
+            )
+        )
+
+    def forward(self, x):
+        if not self._use_kernel(x):
+            return super().forward(x)
+        return layer_norm(x, self.weight, self.bias, self.eps)
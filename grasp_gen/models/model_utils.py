@@ -16,6 +16,7 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from grasp_gen.models.pointnet.pointnet2_modules import PointnetSAModule
 from grasp_gen.utils.logging_config import get_logger
@@ -72,17 +73,26 @@ class SinusoidalPosEmb(nn.Module):
     def __init__(self, dim):
         super().__init__()
         self.dim = dim
+        half_dim = dim // 2
+        emb = math.log(10000) / (half_dim - 1)
+        self.register_buffer(
+            "freqs", torch.exp(torch.arange(half_dim) * -emb), persistent=False
+        )
+
+    def _apply(self, fn, *args, **kwargs):
+        # keep the frequencies in fp32 when the module is cast with .half() or
+        # .to(torch.bfloat16), only the device follows the module
+        freqs = self.freqs
+        super()._apply(fn, *args, **kwargs)
+        self.freqs = freqs.to(self.freqs.device)
+        return self
 
     def forward(self, x):
-        device = x.device
         batch_size = x.shape[0]
-        half_dim = self.dim // 2
-        emb = math.log(10000) / (half_dim - 1)
-        emb = torch.exp(torch.arange(half_dim, device=device) * -emb)
         if len(x.shape) == 1:
-            emb = x[:, None] * emb[None, :]
+            emb = x[:, None] * self.freqs[None, :]
         else:
-            emb = x[:, :, None] * emb[None, None, :]
+            emb = x[:, :, None] * self.freqs[None, None, :]
         emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
         emb = emb.reshape([batch_size, -1])
         return emb
@@ -198,11 +208,46 @@ class MLP(nn.Module):
 class AttentionLayer(nn.Module):
     def __init__(self, embed_dim, num_heads):
         super().__init__()
+        # Only used as a parameter container so that checkpoints stay compatible,
+        # the attention itself goes through F.scaled_dot_product_attention.
         self.attn = nn.MultiheadAttention(embed_dim, num_heads)
         self.norm = nn.LayerNorm(embed_dim)
 
+    def multi_head_attention(self, query, key, value, attn_mask=None):
+        """Fused equivalent of ``nn.MultiheadAttention`` on [L, B, C] inputs.
+
+        Args:
+            attn_mask: [B, L, S] bool tensor shared by all heads, or [B*h, L, S]
+                per head. ``True`` blocks attention (same convention as
+                ``nn.MultiheadAttention``).
+        """
+        L, B, C = query.shape
+        S = key.shape[0]
+        num_heads = self.attn.num_heads
+        head_dim = C // num_heads
+        w_q, w_k, w_v = self.attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.attn.in_proj_bias.chunk(3)
+        # [L, B, C] -> [B, h, L, d]
+        q = F.linear(query, w_q, b_q).view(L, B, num_heads, head_dim)
+        k = F.linear(key, w_k, b_k).view(S, B, num_heads, head_dim)
+        v = F.linear(value, w_v, b_v).view(S, B, num_heads, head_dim)
+        q, k, v = [x.permute(1, 2, 0, 3) for x in (q, k, v)]
+        if attn_mask is not None:
+            # SDPA bool masks mark the positions that are allowed to attend
+            attn_mask = ~attn_mask.view(B, -1, L, S)
+        output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=self.attn.dropout if self.training else 0.0,
+        )
+        # [B, h, L, d] -> [L, B, C]
+        output = output.permute(2, 0, 1, 3).reshape(L, B, C)
+        return self.attn.out_proj(output)
+
     def forward(self, query, key, value, query_pos_enc, key_pos_enc, attn_mask=None):
-        output, attn = self.attn(
+        output = self.multi_head_attention(
             query + query_pos_enc, key + key_pos_enc, value, attn_mask=attn_mask
         )
         return self.norm(query + output)
@@ -33,6 +33,7 @@ Hacked together by / Copyright 2020, Ross Wightman
 """
 import logging
 import math
+import re
 from collections import OrderedDict
 from functools import partial
 from typing import Callable, List, Optional, Sequence, Tuple, Union
@@ -55,25 +56,87 @@ from timm.layers import (
     trunc_normal_,
     use_fused_attn,
 )
-from timm.models._manipulate import adapt_input_conv, checkpoint_seq, named_apply
+from timm.models._manipulate import adapt_input_conv, named_apply
 from torch.jit import Final
 
+from grasp_gen.models.fused_ln import (
+    FusedLayerNorm,
+    fused_add_layer_norm,
+)
+
+try:
+    from flash_attn import flash_attn_qkvpacked_func
+except ImportError:
+    flash_attn_qkvpacked_func = None
+
+try:
+    from safetensors import safe_open
+except ImportError:
+    safe_open = None
+
 _logger = logging.getLogger(__name__)
 
 from timm.layers.weight_init import trunc_normal_tf_
 
+# checkpoint key patterns, compiled once instead of on every key
+_GAMMA_RE = re.compile(r"gamma_([0-9])")
+
+# OpenAI CLIP -> timm key renames, applied in a single regex pass per key. The
+# alternation lists longer names first so e.g. "ln_pre" wins over "ln_".
+_OPENAI_CLIP_SWAPS = (
+    ("visual.", ""),
+    ("conv1", "patch_embed.proj"),
+    ("positional_embedding", "pos_embed"),
+    ("transformer.resblocks.", "blocks."),
+    ("ln_pre", "norm_pre"),
+    ("ln_post", "norm"),
+    ("ln_", "norm"),
+    ("in_proj_", "qkv."),
+    ("out_proj", "proj"),
+    ("mlp.c_fc", "mlp.fc1"),
+    ("mlp.c_proj", "mlp.fc2"),
+)
+_CLIP_SWAPS = dict(_OPENAI_CLIP_SWAPS)
+_CLIP_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_CLIP_SWAPS, key=len, reverse=True))
+)
+
+
+def get_layer_norm(norm_impl: str) -> Callable:
+    """LayerNorm class for the norm_impl argument of VisionTransformer."""
+    if norm_impl == "torch":
+        return nn.LayerNorm
+    if norm_impl == "triton":
+        return FusedLayerNorm
+    if norm_impl == "apex":
+        from apex.normalization import FusedLayerNorm as ApexFusedLayerNorm
+
+        return ApexFusedLayerNorm
+    raise ValueError(
+        f"Unknown norm_impl {norm_impl!r}, expected 'torch', 'triton' or 'apex'"
+    )
+
 
 class SinusoidalPosEmb(nn.Module):
     def __init__(self, dim):
         super().__init__()
         self.dim = dim
+        half_dim = dim // 2
+        emb = math.log(10000) / (half_dim - 1)
+        self.register_buffer(
+            "freqs", torch.exp(torch.arange(half_dim) * -emb), persistent=False
+        )
+
+    def _apply(self, fn, *args, **kwargs):
+        # keep the frequencies in fp32 when the module is cast with .half() or
+        # .to(torch.bfloat16), only the device follows the module
+        freqs = self.freqs
+        super()._apply(fn, *args, **kwargs)
+        self.freqs = freqs.to(self.freqs.device)
+        return self
 
     def forward(self, x):
-        device = x.device
-        half_dim = self.dim // 2
-        emb = math.log(10000) / (half_dim - 1)
-        emb = torch.exp(torch.arange(half_dim, device=device) * -emb)
-        emb = x[:, None] * emb[None, :]
+        emb = x[:, None] * self.freqs[None, :]
         emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
         return emb
 
@@ -90,6 +153,7 @@ class Attention(nn.Module):
         attn_drop=0.0,
         proj_drop=0.0,
         norm_layer=nn.LayerNorm,
+        use_bf16=False,
     ):
         super().__init__()
         assert dim % num_heads == 0, "dim should be divisible by num_heads"
@@ -97,6 +161,7 @@ class Attention(nn.Module):
         self.head_dim = dim // num_heads
         self.scale = self.head_dim**-0.5
         self.fused_attn = use_fused_attn()
+        self.use_bf16 = use_bf16
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.q_norm = norm_layer(self.head_dim) if qk_norm else nn.Identity()
@@ -107,15 +172,40 @@ class Attention(nn.Module):
 
     def forward(self, x):
         B, N, C = x.shape
-        qkv = (
-            self.qkv(x)
-            .reshape(B, N, 3, self.num_heads, self.head_dim)
-            .permute(2, 0, 3, 1, 4)
-        )
-        q, k, v = qkv.unbind(0)
+        qkv = self.qkv(x).view(B, N, 3, self.num_heads, self.head_dim)
+        if (
+            flash_attn_qkvpacked_func is not None
+            and qkv.is_cuda
+            and qkv.dtype in (torch.float16, torch.bfloat16)
+            and isinstance(self.q_norm, nn.Identity)
+        ):
+            # flash-attn consumes the packed (B, N, 3, H, D) projection as is,
+            # so q, k and v never get split out into separate tensors
+            x = flash_attn_qkvpacked_func(
+                qkv,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+                softmax_scale=self.scale,
+            )
+            x = self.proj(x.reshape(B, N, C))
+            x = self.proj_drop(x)
+            return x
+
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
 
-        if self.fused_attn:
+        if self.fused_attn and self.use_bf16 and q.is_cuda:
+            # run attention in bf16 on the flash (or memory efficient) kernels,
+            # the slow math fallback is disabled
+            with torch.backends.cuda.sdp_kernel(
+                enable_flash=True, enable_math=False, enable_mem_efficient=True
+            ):
+                x = F.scaled_dot_product_attention(
+                    q.to(torch.bfloat16),
+                    k.to(torch.bfloat16),
+                    v.to(torch.bfloat16),
+                    dropout_p=self.attn_drop.p if self.training else 0.0,
+                ).to(q.dtype)
+        elif self.fused_attn:
             x = F.scaled_dot_product_attention(
                 q,
                 k,
@@ -123,11 +213,18 @@ class Attention(nn.Module):
                 dropout_p=self.attn_drop.p if self.training else 0.0,
             )
         else:
-            q = q * self.scale
-            attn = q @ k.transpose(-2, -1)
+            # scale folded into the QK^T GEMM instead of a separate pass over q
+            attn = torch.baddbmm(
+                q.new_empty(B * self.num_heads, N, N),
+                q.reshape(B * self.num_heads, N, self.head_dim),
+                k.reshape(B * self.num_heads, N, self.head_dim).transpose(1, 2),
+                beta=0,
+                alpha=self.scale,
+            )
             attn = attn.softmax(dim=-1)
             attn = self.attn_drop(attn)
-            x = attn @ v
+            x = torch.bmm(attn, v.reshape(B * self.num_heads, N, self.head_dim))
+            x = x.view(B, self.num_heads, N, self.head_dim)
 
         x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
@@ -142,7 +239,10 @@ class LayerScale(nn.Module):
         self.gamma = nn.Parameter(init_values * torch.ones(dim))
 
     def forward(self, x):
-        return x.mul_(self.gamma) if self.inplace else x * self.gamma
+        # scaling in place would clobber the input autograd saves for gamma
+        if self.inplace and not torch.is_grad_enabled():
+            return x.mul_(self.gamma)
+        return x * self.gamma
 
 
 class Block(nn.Module):
@@ -161,6 +261,7 @@ class Block(nn.Module):
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
         mlp_layer=Mlp,
+        use_bf16=False,
     ):
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -172,9 +273,12 @@ class Block(nn.Module):
             attn_drop=attn_drop,
             proj_drop=proj_drop,
             norm_layer=norm_layer,
+            use_bf16=use_bf16,
         )
         self.ls1 = (
-            LayerScale(dim, init_values=init_values) if init_values else nn.Identity()
+            LayerScale(dim, init_values=init_values, inplace=True)
+            if init_values
+            else nn.Identity()
         )
         self.drop_path1 = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
 
@@ -186,13 +290,18 @@ class Block(nn.Module):
             drop=proj_drop,
         )
         self.ls2 = (
-            LayerScale(dim, init_values=init_values) if init_values else nn.Identity()
+            LayerScale(dim, init_values=init_values, inplace=True)
+            if init_values
+            else nn.Identity()
         )
         self.drop_path2 = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
 
     def forward(self, x):
-        x = x + self.drop_path1(self.ls1(self.attn(self.norm1(x))))
-        x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x))))
+        # the attention residual add and norm2 share one pass over the sum
+        x, h = fused_add_layer_norm(
+            self.drop_path1(self.ls1(self.attn(self.norm1(x)))), x, self.norm2
+        )
+        x = x + self.drop_path2(self.ls2(self.mlp(h)))
         return x
 
 
@@ -239,6 +348,9 @@ class VisionTransformer(nn.Module):
         act_layer: Optional[Callable] = None,
         block_fn: Callable = Block,
         mlp_layer: Callable = Mlp,
+        use_bf16: bool = False,
+        independent_views: bool = False,
+        norm_impl: str = "torch",
     ):
         """
         Args:
@@ -266,12 +378,18 @@ class VisionTransformer(nn.Module):
             norm_layer: Normalization layer.
             act_layer: MLP activation layer.
             block_fn: Transformer block layer.
+            use_bf16: Run the CUDA patch embedding and attention in bf16.
+            independent_views: Encode the S input views as separate sequences
+                (no cross-view attention) instead of one joint sequence.
+            norm_impl: LayerNorm used when norm_layer is not given, one of
+                'torch' (nn.LayerNorm), 'triton' (FusedLayerNorm, Triton kernel
+                for inference) or 'apex' (apex FusedLayerNorm).
         """
         super().__init__()
         assert global_pool in ("", "avg", "token", "map")
         assert class_token or global_pool != "token"
         use_fc_norm = global_pool == "avg" if fc_norm is None else fc_norm
-        norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
+        norm_layer = norm_layer or partial(get_layer_norm(norm_impl), eps=1e-6)
         act_layer = act_layer or nn.GELU
 
         self.num_classes = num_classes
@@ -288,6 +406,8 @@ class VisionTransformer(nn.Module):
         )
         self.dynamic_img_size = dynamic_img_size
         self.grad_checkpointing = False
+        self.use_bf16 = use_bf16
+        self.independent_views = independent_views
 
         embed_args = {}
         if dynamic_img_size:
@@ -302,6 +422,7 @@ class VisionTransformer(nn.Module):
             dynamic_img_pad=dynamic_img_pad,
             **embed_args,
         )
+        self.patch_embed.to(memory_format=torch.channels_last)
         num_patches = self.patch_embed.num_patches
 
         self.cls_token = (
@@ -324,9 +445,9 @@ class VisionTransformer(nn.Module):
             self.patch_drop = nn.Identity()
         self.norm_pre = norm_layer(embed_dim) if pre_norm else nn.Identity()
 
-        dpr = [
-            x.item() for x in torch.linspace(0, drop_path_rate, depth)
-        ]  # stochastic depth decay rule
+        dpr = torch.linspace(
+            0, drop_path_rate, depth
+        ).tolist()  # stochastic depth decay rule
         self.blocks = nn.Sequential(
             *[
                 block_fn(
@@ -342,6 +463,7 @@ class VisionTransformer(nn.Module):
                     norm_layer=norm_layer,
                     act_layer=act_layer,
                     mlp_layer=mlp_layer,
+                    use_bf16=use_bf16,
                 )
                 for i in range(depth)
             ]
@@ -383,7 +505,18 @@ class VisionTransformer(nn.Module):
 
     @torch.jit.ignore()
     def load_pretrained(self, checkpoint_path, prefix=""):
-        _load_weights(self, checkpoint_path, prefix)
+        """Load a .npz (big_vision), .safetensors or torch .pth / .pt checkpoint.
+
+        prefix only applies to .npz checkpoints.
+        """
+        if checkpoint_path.endswith(".safetensors"):
+            load_checkpoint_safetensors(checkpoint_path, self)
+        elif checkpoint_path.endswith((".pth", ".pt")):
+            state_dict = torch.load(checkpoint_path, map_location="cpu")
+            # the loaded dict is not used anywhere else, convert it in place
+            self.load_state_dict(checkpoint_filter_fn(state_dict, self, inplace=True))
+        else:
+            _load_weights(self, checkpoint_path, prefix)
 
     @torch.jit.ignore
     def no_weight_decay(self):
@@ -425,6 +558,9 @@ class VisionTransformer(nn.Module):
         else:
             pos_embed = self.pos_embed
 
+        if not torch.is_grad_enabled() and self.num_prefix_tokens > 0:
+            return self.pos_drop(self._pos_embed_inplace(x, pos_embed))
+
         to_cat = []
         if self.cls_token is not None:
             to_cat.append(self.cls_token.expand(x.shape[0], -1, -1))
@@ -446,26 +582,64 @@ class VisionTransformer(nn.Module):
 
         return self.pos_drop(x)
 
+    def _pos_embed_inplace(self, x, pos_embed):
+        # Same result as the concat path in _pos_embed, but the tokens are
+        # written into one fresh buffer and the position embedding is added in
+        # place, instead of materializing the concat and the sum separately.
+        # Inference only, the in-place add is not meant to be differentiated.
+        B, N, C = x.shape
+        num_prefix = self.num_prefix_tokens
+        dtype = torch.promote_types(x.dtype, pos_embed.dtype)
+        buf = x.new_empty(B, num_prefix + N, C, dtype=dtype)
+        buf[:, :num_prefix] = self._prefix_tokens()
+        buf[:, num_prefix:] = x
+        if self.no_embed_class:
+            buf[:, num_prefix:] += pos_embed
+        else:
+            buf[:, num_prefix:] += pos_embed[:, num_prefix:]
+        return buf
+
+    def _prefix_tokens(self):
+        # [1, num_prefix, C] class and register tokens, with their position
+        # embedding already added (resampling never touches the prefix part).
+        # Only num_prefix rows, broadcast over the batch when written out.
+        prefix = [p for p in (self.cls_token, self.reg_token) if p is not None]
+        prefix = torch.cat(prefix, dim=1)
+        if not self.no_embed_class:
+            prefix = prefix + self.pos_embed[:, : self.num_prefix_tokens]
+        return prefix
+
     def _intermediate_layers(
         self,
         x: torch.Tensor,
         n: Union[int, Sequence] = 1,
     ):
-        outputs, num_blocks = [], len(self.blocks)
-        take_indices = set(
+        num_blocks = len(self.blocks)
+        take_indices = frozenset(
             range(num_blocks - n, num_blocks) if isinstance(n, int) else n
         )
+        take_mask = tuple(i in take_indices for i in range(num_blocks))
+        if not any(take_mask):
+            return []
+        # blocks after the last requested one do not contribute to the outputs
+        take_mask = take_mask[: num_blocks - take_mask[::-1].index(True)]
 
         # forward pass
         x = self.patch_embed(x)
         x = self._pos_embed(x)
         x = self.patch_drop(x)
         x = self.norm_pre(x)
-        for i, blk in enumerate(self.blocks):
+        return self._run_blocks(x, take_mask)
+
+    def _run_blocks(self, x, take_mask: Tuple[bool, ...]):
+        # take_mask is a static tuple, so torch.compile can unroll the loop and
+        # specialize on the captured blocks. The blocks never modify their
+        # input, so the captured tensors need no clone.
+        outputs = []
+        for blk, take in zip(self.blocks, take_mask):
             x = blk(x)
-            if i in take_indices:
+            if take:
                 outputs.append(x)
-
         return outputs
 
     def get_intermediate_layers(
@@ -488,10 +662,12 @@ class VisionTransformer(nn.Module):
 
         if reshape:
             grid_size = self.patch_embed.grid_size
+            # the tokens are already laid out NHWC, returning them channels_last
+            # avoids transposing the whole grid into NCHW memory order
             outputs = [
                 out.reshape(x.shape[0], grid_size[0], grid_size[1], -1)
                 .permute(0, 3, 1, 2)
-                .contiguous()
+                .contiguous(memory_format=torch.channels_last)
                 for out in outputs
             ]
 
@@ -501,21 +677,34 @@ class VisionTransformer(nn.Module):
 
     def forward_features(self, x):
         # x: img B ,S, H , W , C
-        x = x.permute(0, 1, 4, 2, 3)
         B, S = x.shape[0], x.shape[1]
-        x = x.flatten(0, 1)  # bs, c, h, w
-
-        x = self.patch_embed(x)  # bs, num_patch, embed_dim
+        # merging B and S is a view, and the NHWC input permuted to NCHW already
+        # has channels_last strides, so this does not copy
+        x = x.flatten(0, 1).permute(0, 3, 1, 2)  # bs, c, h, w
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        with torch.autocast(
+            "cuda", dtype=torch.bfloat16, enabled=self.use_bf16 and x.is_cuda
+        ):
+            x = self.patch_embed(x)  # bs, num_patch, embed_dim
         x = self._pos_embed(x)
-        x = x.reshape(B, S, x.shape[1], x.shape[2]).reshape(B, -1, x.shape[-1])
+        if not self.independent_views:
+            # all views are attended jointly as one sequence
+            x = x.reshape(B, S * x.shape[1], x.shape[2])
         x = self.patch_drop(x)
         x = self.norm_pre(x)
         if self.grad_checkpointing and not torch.jit.is_scripting():
-            x = checkpoint_seq(self.blocks, x)
+            # checkpoint every other block, about half the activation memory
+            # savings for half the recompute of checkpointing all of them
+            for i, blk in enumerate(self.blocks):
+                if i % 2 == 0:
+                    x = torch.utils.checkpoint.checkpoint(blk, x, use_reentrant=False)
+                else:
+                    x = blk(x)
         else:
             x = self.blocks(x)
         x = self.norm(x)
-        return x
+        return x.reshape(B, -1, x.shape[-1])
 
     def forward_head(self, x, pre_logits: bool = False):
         if self.attn_pool is not None:
@@ -536,6 +725,37 @@ class VisionTransformer(nn.Module):
         return x
 
 
+def compile_vit(model: VisionTransformer) -> VisionTransformer:
+    """Compile the forward of a ViT with torch.compile in CUDA graph mode.
+
+    Only the bound forward and block loop are replaced, so the module itself
+    (and its state_dict keys) stay the same. Input shapes are expected to be
+    static.
+    The model has to use nn.LayerNorm (norm_impl='torch'), the Triton kernels
+    of FusedLayerNorm would split the graph at every norm.
+    """
+    if any(isinstance(m, FusedLayerNorm) for m in model.modules()):
+        raise ValueError("compile_vit needs a ViT built with norm_impl='torch'")
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", dynamic=False)
+    # get_intermediate_layers does not go through forward. Its block loop is
+    # compiled without CUDA graphs, a replay would overwrite the outputs that
+    # an earlier call returned.
+    model._run_blocks = torch.compile(model._run_blocks, dynamic=False)
+    return model
+
+
+def compile_vit_mlps(model: VisionTransformer) -> VisionTransformer:
+    """Compile the MLP of every block so fc1's bias add and GELU get fused.
+
+    Like compile_vit, only bound methods are swapped, parameters and
+    state_dict keys are left as they are.
+    """
+    compile = partial(torch.compile, dynamic=False, mode="max-autotune")
+    for blk in model.blocks:
+        blk.mlp.forward = compile(blk.mlp.forward)
+    return model
+
+
 def init_weights_vit_timm(module: nn.Module, name: str = ""):
     """ViT weight initialization, original timm impl (for reproducibility)"""
     if isinstance(module, nn.Linear):
@@ -655,6 +875,9 @@ def _load_weights(model: nn.Module, checkpoint_path: str, prefix: str = ""):
                 w = w.transpose([1, 0])
         return torch.from_numpy(w)
 
+    def _flat_kernel(w):
+        return w.reshape(w.shape[0], -1)
+
     w = np.load(checkpoint_path)
     interpolation = "bilinear"
     antialias = False
@@ -800,20 +1023,26 @@ def _load_weights(model: nn.Module, checkpoint_path: str, prefix: str = ""):
         mha_prefix = block_prefix + f"MultiHeadDotProductAttention_{mha_sub}/"
         block.norm1.weight.copy_(_n2p(w[f"{block_prefix}LayerNorm_0/scale"]))
         block.norm1.bias.copy_(_n2p(w[f"{block_prefix}LayerNorm_0/bias"]))
+        # q, k and v are packed in numpy, so each block needs one conversion to
+        # torch instead of three and a torch.cat
         block.attn.qkv.weight.copy_(
-            torch.cat(
-                [
-                    _n2p(w[f"{mha_prefix}{n}/kernel"], t=False).flatten(1).T
-                    for n in ("query", "key", "value")
-                ]
+            torch.from_numpy(
+                np.concatenate(
+                    [
+                        _flat_kernel(w[f"{mha_prefix}{n}/kernel"]).T
+                        for n in ("query", "key", "value")
+                    ]
+                )
             )
         )
         block.attn.qkv.bias.copy_(
-            torch.cat(
-                [
-                    _n2p(w[f"{mha_prefix}{n}/bias"], t=False).reshape(-1)
-                    for n in ("query", "key", "value")
-                ]
+            torch.from_numpy(
+                np.concatenate(
+                    [
+                        w[f"{mha_prefix}{n}/bias"].reshape(-1)
+                        for n in ("query", "key", "value")
+                    ]
+                )
             )
         )
         block.attn.proj.weight.copy_(_n2p(w[f"{mha_prefix}out/kernel"]).flatten(1))
@@ -831,36 +1060,29 @@ def _load_weights(model: nn.Module, checkpoint_path: str, prefix: str = ""):
 
 def _convert_openai_clip(state_dict, model):
     out_dict = {}
-    swaps = [
-        ("visual.", ""),
-        ("conv1", "patch_embed.proj"),
-        ("positional_embedding", "pos_embed"),
-        ("transformer.resblocks.", "blocks."),
-        ("ln_pre", "norm_pre"),
-        ("ln_post", "norm"),
-        ("ln_", "norm"),
-        ("in_proj_", "qkv."),
-        ("out_proj", "proj"),
-        ("mlp.c_fc", "mlp.fc1"),
-        ("mlp.c_proj", "mlp.fc2"),
-    ]
-    for k, v in state_dict.items():
-        if not k.startswith("visual."):
-            continue
-        for sp in swaps:
-            k = k.replace(sp[0], sp[1])
+    # only the vision tower is converted, drop the text tower keys up front
+    items = [(k, v) for k, v in state_dict.items() if k.startswith("visual.")]
+    for k, v in items:
+        k = _CLIP_RE.sub(lambda m: _CLIP_SWAPS[m.group(0)], k)
 
         if k == "proj":
             k = "head.weight"
-            v = v.transpose(0, 1)
-            out_dict["head.bias"] = torch.zeros(v.shape[0])
+            # materialized once here, so load_state_dict(assign=True) can take
+            # the tensor as is instead of copying a transposed view later
+            v = v.t().contiguous()
+            out_dict["head.bias"] = torch.zeros(
+                v.shape[0], dtype=v.dtype, device=v.device
+            )
         elif k == "class_embedding":
             k = "cls_token"
-            v = v.unsqueeze(0).unsqueeze(1)
+            v = v[None, None]
         elif k == "pos_embed":
-            v = v.unsqueeze(0)
+            v = v[None]
             if v.shape[1] != model.pos_embed.shape[1]:
                 # To resize pos embedding when using model at different size from pretrained weights
+                if model.pos_embed.is_cuda:
+                    # interpolate where the model lives, much faster than on cpu
+                    v = v.to(model.pos_embed.device, non_blocking=True)
                 v = resize_pos_embed(
                     v,
                     model.pos_embed,
@@ -875,21 +1097,15 @@ def _convert_openai_clip(state_dict, model):
     return out_dict
 
 
-def _convert_dinov2(state_dict, model):
-    import re
-
-    out_dict = {}
-    for k, v in state_dict.items():
-        if k == "mask_token":
-            continue
-        elif re.match(r"blocks\.(\d+)\.mlp\.w12\.(?:weight|bias)", k):
-            out_dict[k.replace("w12", "fc1")] = v
-            continue
-        elif re.match(r"blocks\.(\d+)\.mlp\.w3\.(?:weight|bias)", k):
-            out_dict[k.replace("w3", "fc2")] = v
-            continue
-        out_dict[k] = v
-    return out_dict
+def _dinov2_rename_key(k: str) -> Optional[str]:
+    """timm name of a dinov2 checkpoint key, None for keys that are dropped."""
+    if k == "mask_token":
+        return None
+    if "mlp.w12." in k:
+        return k.replace("mlp.w12.", "mlp.fc1.")
+    if "mlp.w3." in k:
+        return k.replace("mlp.w3.", "mlp.fc2.")
+    return k
 
 
 def checkpoint_filter_fn(
@@ -898,71 +1114,224 @@ def checkpoint_filter_fn(
     adapt_layer_scale=False,
     interpolation="bicubic",
     antialias=True,
+    verbose=False,
+    inplace=False,
 ):
-    """convert patch embedding weight from manual patchify + linear proj to conv"""
-    import re
-
-    out_dict = {}
+    """convert patch embedding weight from manual patchify + linear proj to conv
+
+    Tensors that need no conversion are passed through untouched (the others
+    only go through views or the patch / pos embed resampling), nothing is
+    copied or moved to the cpu. Checkpoints loaded with
+    ``torch.load(..., mmap=True)`` therefore stay memory mapped; pair this with
+    ``model.load_state_dict(out, assign=True)`` to keep peak host memory at
+    roughly the size of the resampled embeddings.
+
+    The converted weights are returned in a new dict and the input is left as
+    it is. With inplace set, the (innermost) state dict is converted in place
+    and returned instead, so no second dict of the whole checkpoint is built.
+    The caller's dict is modified then and cannot be filtered again. OpenAI
+    CLIP checkpoints are always converted into a new dict.
+
+    With verbose set the patch / pos embed resampling is logged, only on rank 0
+    in a distributed job.
+    """
     state_dict = state_dict.get("model", state_dict)
     state_dict = state_dict.get("state_dict", state_dict)
     prefix = ""
 
-    if "visual.class_embedding" in state_dict:
-        return _convert_openai_clip(state_dict, model)
+    # checkpoint format, detected once up front
+    is_openai_clip = "visual.class_embedding" in state_dict
+    # dinov2 keys are renamed inside the main loop below instead of in a
+    # separate pass building another dict
+    is_dinov2 = "mask_token" in state_dict
+    has_encoder = "encoder" in state_dict
 
-    if "mask_token" in state_dict:
-        state_dict = _convert_dinov2(state_dict, model)
+    if is_openai_clip:
+        return _convert_openai_clip(state_dict, model)
 
-    if "encoder" in state_dict:
+    if has_encoder:
         state_dict = state_dict["encoder"]
         prefix = "module."
 
+    # looked up after unwrapping the encoder, the key lives in the inner dict
     if "visual.trunk.pos_embed" in state_dict:
         # convert an OpenCLIP model with timm vision encoder
         # FIXME remap final nn.Linear if it exists outside of the timm .trunk (ie in visual.head.proj)
         prefix = "visual.trunk."
 
-    if prefix:
-        # filter on & remove prefix string from keys
-        state_dict = {
-            k[len(prefix) :]: v for k, v in state_dict.items() if k.startswith(prefix)
-        }
+    convert = _tensor_filter(model, interpolation, antialias, verbose)
+    out_dict = state_dict if inplace else {}
+    items = state_dict.items()
+    if inplace:
+        # emptied before the converted keys go back in, so a renamed key never
+        # clashes with an old one still waiting to be visited
+        items = list(items)
+        state_dict.clear()
+    for k, v in items:
+        if prefix:
+            # filter on & remove prefix string from keys
+            if not k.startswith(prefix):
+                continue
+            k = k[len(prefix) :]
+        k = _filter_key(k, is_dinov2, adapt_layer_scale)
+        if k is not None:
+            out_dict[k] = convert(k, v)
+    return out_dict
 
-    for k, v in state_dict.items():
+
+def _filter_key(k, is_dinov2, adapt_layer_scale):
+    """Model name of checkpoint key k, None if the key is dropped."""
+    if is_dinov2:
+        k = _dinov2_rename_key(k)
+        if k is None:
+            return None
+    if adapt_layer_scale and "gamma_" in k:
+        # remap layer-scale gamma into sub-module (deit3 models)
+        return _GAMMA_RE.sub(r"ls\1.gamma", k)
+    if "pre_logits" in k:
+        # NOTE representation layer removed as not used in latest 21k/1k pretrained weights
+        return None
+    return k
+
+
+def _may_resample(k):
+    """Whether convert (see _tensor_filter) can change the shape of key k."""
+    return "patch_embed.proj.weight" in k or k == "pos_embed"
+
+
+def _tensor_filter(model, interpolation, antialias, verbose=False):
+    """Returns convert(k, v), which adapts tensor v of (renamed) key k to model."""
+    if verbose and torch.distributed.is_available():
+        # every rank converts its own copy, only log it once
+        verbose = (
+            not torch.distributed.is_initialized()
+            or torch.distributed.get_rank() == 0
+        )
+    # model attributes used for every key, looked up once
+    pe_shape = model.patch_embed.proj.weight.shape
+    pos_embed_len = model.pos_embed.shape[1]
+    pos_embed_device = model.pos_embed.device
+    grid_size = model.patch_embed.grid_size
+    num_prefix_tokens = (
+        0
+        if getattr(model, "no_embed_class", False)
+        else getattr(model, "num_prefix_tokens", 1)
+    )
+
+    def convert(k, v):
         if "patch_embed.proj.weight" in k:
-            O, I, H, W = model.patch_embed.proj.weight.shape
             if len(v.shape) < 4:
                 # For old models that I trained prior to conv based patchification
-                O, I, H, W = model.patch_embed.proj.weight.shape
-                v = v.reshape(O, -1, H, W)
-            if v.shape[-1] != W or v.shape[-2] != H:
+                v = v.reshape(pe_shape[0], -1, pe_shape[2], pe_shape[3])
+            if v.shape[-2:] != pe_shape[-2:]:
                 v = resample_patch_embed(
                     v,
-                    (H, W),
+                    tuple(pe_shape[-2:]),
                     interpolation=interpolation,
                     antialias=antialias,
-                    verbose=True,
+                    verbose=verbose,
                 )
-        elif k == "pos_embed" and v.shape[1] != model.pos_embed.shape[1]:
+        elif k == "pos_embed" and v.shape[1] != pos_embed_len:
             # To resize pos embedding when using model at different size from pretrained weights
-            num_prefix_tokens = (
-                0
-                if getattr(model, "no_embed_class", False)
-                else getattr(model, "num_prefix_tokens", 1)
-            )
+            if pos_embed_device.type == "cuda":
+                # interpolate where the model lives, much faster than on cpu
+                v = v.to(pos_embed_device, non_blocking=True)
             v = resample_abs_pos_embed(
                 v,
-                new_size=model.patch_embed.grid_size,
+                new_size=grid_size,
                 num_prefix_tokens=num_prefix_tokens,
                 interpolation=interpolation,
                 antialias=antialias,
-                verbose=True,
+                verbose=verbose,
             )
-        elif adapt_layer_scale and "gamma_" in k:
-            # remap layer-scale gamma into sub-module (deit3 models)
-            k = re.sub(r"gamma_([0-9])", r"ls\1.gamma", k)
-        elif "pre_logits" in k:
-            # NOTE representation layer removed as not used in latest 21k/1k pretrained weights
-            continue
-        out_dict[k] = v
-    return out_dict
+        return v
+
+    return convert
+
+
+def load_checkpoint_safetensors(
+    path,
+    model,
+    adapt_layer_scale=False,
+    interpolation="bicubic",
+    antialias=True,
+    verbose=False,
+    strict=True,
+):
+    """checkpoint_filter_fn + load_state_dict for a .safetensors file
+
+    The keys are renamed from the file header only. Each tensor is then read,
+    converted and copied into the matching model tensor before the next one is
+    read, so only one checkpoint tensor is in host memory at a time.
+
+    Returns the missing and unexpected keys, as ``model.load_state_dict``.
+    """
+    if safe_open is None:
+        raise ImportError(
+            "Loading .safetensors checkpoints requires the safetensors package, "
+            "install it with `pip install safetensors`."
+        )
+
+    with safe_open(path, framework="pt", device="cpu") as handle:
+        keys = list(handle.keys())
+        if "visual.class_embedding" in keys:
+            # OpenAI CLIP conversion synthesizes keys, convert it eagerly
+            state_dict = {k: handle.get_tensor(k) for k in keys}
+            return model.load_state_dict(
+                _convert_openai_clip(state_dict, model), strict=strict
+            )
+
+        is_dinov2 = "mask_token" in keys
+        prefix = "visual.trunk." if "visual.trunk.pos_embed" in keys else ""
+        entries = {}
+        for source_key in keys:
+            k = source_key.removeprefix(prefix)
+            if prefix and len(k) == len(source_key):
+                continue
+            k = _filter_key(k, is_dinov2, adapt_layer_scale)
+            if k is not None:
+                entries[k] = source_key
+
+        target = model.state_dict()
+        missing_keys = [k for k in target if k not in entries]
+        unexpected_keys = [k for k in entries if k not in target]
+        if strict and (missing_keys or unexpected_keys):
+            raise RuntimeError(
+                f"Error(s) in loading {path} into {model.__class__.__name__}: "
+                f"missing keys {missing_keys}, unexpected keys {unexpected_keys}"
+            )
+        entries = {k: v for k, v in entries.items() if k in target}
+
+        # Every shape is checked before the first copy, so a mismatch never
+        # leaves the model half loaded. The patch and pos embeds may get
+        # resampled and are converted up front, the other shapes come from
+        # the file header.
+        convert = _tensor_filter(model, interpolation, antialias, verbose)
+        converted = {
+            k: convert(k, handle.get_tensor(source_key))
+            for k, source_key in entries.items()
+            if _may_resample(k)
+        }
+        mismatched = []
+        for k, source_key in entries.items():
+            if k in converted:
+                shape = tuple(converted[k].shape)
+            else:
+                shape = tuple(handle.get_slice(source_key).get_shape())
+            if shape != tuple(target[k].shape):
+                mismatched.append(
+                    f"{k}: {shape} in checkpoint, {tuple(target[k].shape)} in model"
+                )
+        if mismatched:
+            raise RuntimeError(
+                f"size mismatch in loading {path}: " + ", ".join(mismatched)
+            )
+
+        with torch.no_grad():
+            for k, source_key in entries.items():
+                if k in converted:
+                    v = converted.pop(k)
+                else:
+                    v = handle.get_tensor(source_key)
+                target[k].copy_(v)
+    return missing_keys, unexpected_keys
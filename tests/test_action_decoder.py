@@ -0,0 +1,277 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+from grasp_gen.models.action_decoder import (
+    ActionDecoder,
+    _build_6d_grasp,
+    build_6d_grasp,
+    double_split,
+)
+from grasp_gen.robot import get_gripper_info
+
+CONFIG_PATH = Path(__file__).parent.parent / "scripts" / "config.yaml"
+
+
+def closed_form_6d_grasp(
+    contact_pt, contact_dir, approach_dir, offset, gripper_depth, symmetric
+):
+    """6D grasp built with the original stack / cat formulation."""
+    grasp_translation = contact_pt - gripper_depth * approach_dir
+    if symmetric:
+        grasp_translation = grasp_translation + contact_dir * offset.unsqueeze(-1) / 2
+    grasp_tr = torch.stack(
+        [
+            contact_dir,
+            torch.cross(approach_dir, contact_dir, dim=-1),
+            approach_dir,
+            grasp_translation,
+        ],
+        dim=-1,
+    )
+    last_row = torch.tensor([0.0, 0.0, 0.0, 1.0]).expand(*grasp_tr.shape[:-2], 1, 4)
+    return torch.cat([grasp_tr, last_row], dim=-2)
+
+
+def random_grasp_inputs(*shape):
+    contact_pt = torch.randn(*shape, 3)
+    contact_dir = F.normalize(torch.randn(*shape, 3), dim=-1)
+    approach_dir = torch.randn(*shape, 3)
+    approach_dir = F.normalize(
+        approach_dir
+        - contact_dir * (approach_dir * contact_dir).sum(dim=-1, keepdim=True),
+        dim=-1,
+    )
+    offset = torch.rand(*shape) * 0.08
+    return contact_pt, contact_dir, approach_dir, offset
+
+
+@pytest.mark.parametrize("gripper_name", ["franka_panda", "robotiq_2f_140"])
+def test_build_6d_grasp_matches_closed_form(gripper_name, random_seed):
+    """Test build_6d_grasp against the closed form for a registered gripper."""
+    gripper_info = get_gripper_info(gripper_name)
+    inputs = random_grasp_inputs(64)
+
+    grasps = build_6d_grasp(*inputs, gripper_name=gripper_name)
+    expected = closed_form_6d_grasp(
+        *inputs, gripper_info.depth, gripper_info.symmetric
+    )
+
+    assert grasps.shape == (64, 4, 4)
+    assert torch.allclose(grasps, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("symmetric", [True, False])
+@pytest.mark.parametrize("shape", [(0,), (16,), (2, 8)])
+def test_scripted_6d_grasp_matches_closed_form(symmetric, shape, random_seed):
+    """Test the scripted builder for both symmetry modes and batch shapes."""
+    inputs = random_grasp_inputs(*shape)
+
+    grasps = _build_6d_grasp(*inputs, 0.1, symmetric)
+    expected = closed_form_6d_grasp(*inputs, 0.1, symmetric)
+
+    assert grasps.shape == (*shape, 4, 4)
+    assert torch.allclose(grasps, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("gripper_name", ["franka_panda", "robotiq_2f_140"])
+def test_action_decoder_from_gripper_config(gripper_name):
+    """Test building an ActionDecoder from the training config of a gripper."""
+    cfg = OmegaConf.load(CONFIG_PATH).m2t2.action_decoder
+    cfg.gripper_name = gripper_name
+    contact_decoder = SimpleNamespace(mask_dim=32, embed_dim=64)
+    gripper_info = get_gripper_info(gripper_name)
+
+    decoder = ActionDecoder.from_config(cfg, contact_decoder)
+
+    assert decoder.gripper_name == gripper_name
+    assert decoder._grasp_depth == pytest.approx(gripper_info.depth)
+    assert decoder._symmetric_antipodal == bool(gripper_info.symmetric)
+    assert decoder.offset_vals.shape[0] == len(gripper_info.offset_bins) - 1
+
+
+def make_decoder(use_embed, max_num_pred=None):
+    decoder = ActionDecoder(
+        mask_dim=8,
+        use_embed=use_embed,
+        embed_dim=4,
+        max_num_pred=max_num_pred,
+        hidden_dim=16,
+        num_layers=2,
+        activation="ReLU",
+        offset_bins=[0.0, 0.02, 0.04, 0.08],
+        gripper_depth=0.1,
+        gripper_name="franka_panda",
+        grasp_depth=0.1,
+        symmetric_antipodal=True,
+    )
+    return decoder.eval()
+
+
+def make_decoder_inputs(objs_per_scene, num_points=50):
+    batch_size = len(objs_per_scene)
+    xyz = torch.randn(batch_size, num_points, 3)
+    mask_feats = torch.randn(batch_size, 8, num_points)
+    confidence = [torch.rand(n, num_points) for n in objs_per_scene]
+    embedding = [torch.randn(n, 4) for n in objs_per_scene]
+    gt_masks = [(torch.rand(n, num_points) > 0.8).float() for n in objs_per_scene]
+    return xyz, mask_feats, confidence, embedding, gt_masks
+
+
+def nested_split(tensor, num_grasps):
+    scenes = tensor.split([sum(num) for num in num_grasps])
+    return [list(scene.split(num)) for scene, num in zip(scenes, num_grasps)]
+
+
+def loop_forward(
+    decoder, xyz, mask_feats, confidence, mask_thresh, embedding, gt_masks
+):
+    """Per-object reference of ActionDecoder.forward without subsampling."""
+    mask_feats = mask_feats.moveaxis(1, -1)
+    contacts, conf_all, inputs, num_grasps = [], [], [], []
+    for i, (pts, feat, emb, conf_scene) in enumerate(
+        zip(xyz, mask_feats, embedding, confidence)
+    ):
+        masks = conf_scene > mask_thresh
+        if gt_masks is not None:
+            masks = masks | (gt_masks[i] > 0)
+        conf_list, num = [], []
+        for e, m, conf in zip(emb, masks, conf_scene):
+            f = feat[m]
+            if decoder.use_embed:
+                f = torch.cat([f, e.expand(f.shape[0], -1)], dim=-1)
+            contacts.append(pts[m])
+            inputs.append(f)
+            conf_list.append(conf[m])
+            num.append(f.shape[0])
+        conf_all.append(conf_list)
+        num_grasps.append(num)
+    contacts = torch.cat(contacts) if contacts else xyz.new_zeros(0, 3)
+    inputs = torch.cat(inputs) if inputs else xyz.new_zeros(0, decoder.feat_dim)
+    total_grasps = inputs.shape[0]
+
+    if gt_masks is not None:
+        feats = mask_feats
+        if decoder.use_embed:
+            embed = torch.stack(
+                [emb.T @ mask for emb, mask in zip(embedding, gt_masks)]
+            ).transpose(1, 2)
+            feats = torch.cat([mask_feats, embed], dim=-1)
+        gt_inputs = torch.cat(
+            [feat[(mask > 0).any(dim=0)] for feat, mask in zip(feats, gt_masks)]
+        )
+        inputs = torch.cat([inputs, gt_inputs])
+
+    contact_dirs = F.normalize(decoder.contact_dir_head(inputs), dim=-1)
+    approach_dirs = decoder.approach_dir_head(inputs)
+    approach_dirs = F.normalize(
+        approach_dirs
+        - contact_dirs * (approach_dirs * contact_dirs).sum(dim=-1, keepdim=True),
+        dim=-1,
+    )
+    offset_logits = decoder.offset_head(inputs)
+    offsets = decoder.offset_vals[offset_logits.argmax(dim=-1)]
+    grasps = closed_form_6d_grasp(
+        contacts,
+        contact_dirs[:total_grasps],
+        approach_dirs[:total_grasps],
+        offsets[:total_grasps],
+        decoder._grasp_depth,
+        decoder._symmetric_antipodal,
+    )
+    return {
+        "grasps": nested_split(grasps, num_grasps),
+        "grasp_confidence": conf_all,
+        "grasp_contacts": nested_split(contacts, num_grasps),
+        "contact_dirs": contact_dirs[total_grasps:],
+        "approach_dirs": approach_dirs[total_grasps:],
+        "offsets": offset_logits[total_grasps:],
+    }
+
+
+def assert_nested_close(actual, expected):
+    assert len(actual) == len(expected)
+    for actual_scene, expected_scene in zip(actual, expected):
+        assert len(actual_scene) == len(expected_scene)
+        for a, e in zip(actual_scene, expected_scene):
+            assert a.shape == e.shape
+            assert torch.allclose(a, e, atol=1e-5)
+
+
+@pytest.mark.parametrize("use_embed", [False, True])
+@pytest.mark.parametrize("use_gt_masks", [False, True])
+def test_action_decoder_matches_object_loop(use_embed, use_gt_masks, random_seed):
+    """Test the batched contact gathering against the per-object loop."""
+    decoder = make_decoder(use_embed)
+    xyz, mask_feats, confidence, embedding, gt_masks = make_decoder_inputs([3, 0, 2])
+    if not use_gt_masks:
+        gt_masks = None
+
+    with torch.no_grad():
+        outputs = decoder(xyz, mask_feats, confidence, 0.5, embedding, gt_masks)
+        expected = loop_forward(
+            decoder, xyz, mask_feats, confidence, 0.5, embedding, gt_masks
+        )
+
+    for key in ["grasps", "grasp_confidence", "grasp_contacts"]:
+        assert_nested_close(outputs[key], expected[key])
+    num_objs = sum(len(conf) for conf in confidence)
+    num_grasps = sum(g.shape[0] for scene in expected["grasps"] for g in scene)
+    assert outputs["num_pred_grasps"].item() == pytest.approx(num_grasps / num_objs)
+    if use_gt_masks:
+        for key in ["contact_dirs", "approach_dirs", "offsets"]:
+            assert torch.allclose(outputs[key], expected[key], atol=1e-5)
+
+
+def test_action_decoder_subsamples_contacts(random_seed):
+    """Test that max_num_pred keeps a random subset of each object's contacts."""
+    decoder = make_decoder(use_embed=True, max_num_pred=5)
+    xyz, mask_feats, confidence, embedding, _ = make_decoder_inputs([3, 2])
+
+    with torch.no_grad():
+        outputs = decoder(xyz, mask_feats, confidence, 0.5, embedding)
+
+    for pts, conf_scene, contacts, conf_pred in zip(
+        xyz, confidence, outputs["grasp_contacts"], outputs["grasp_confidence"]
+    ):
+        for conf, obj_contacts, obj_conf in zip(conf_scene, contacts, conf_pred):
+            mask = conf > 0.5
+            assert obj_contacts.shape[0] == min(int(mask.sum()), 5)
+            assert (obj_conf > 0.5).all()
+            if obj_contacts.shape[0] > 0:
+                dist = torch.cdist(obj_contacts, pts[mask])
+                assert torch.allclose(dist.min(dim=1)[0], torch.zeros(1))
+
+
+def test_action_decoder_without_scenes():
+    """Test that an empty batch gives empty outputs instead of failing."""
+    decoder = make_decoder(use_embed=True)
+    xyz, mask_feats, confidence, embedding, _ = make_decoder_inputs([])
+
+    with torch.no_grad():
+        outputs = decoder(xyz, mask_feats, confidence, 0.5, embedding)
+
+    assert outputs["grasps"] == []
+    assert outputs["grasp_confidence"] == []
+    assert outputs["grasp_contacts"] == []
+    assert outputs["num_pred_grasps"].item() == 0
+
+
+def test_double_split_returns_nested_lists():
+    """Test that double_split gives plain [scene][object] lists of views."""
+    tensor = torch.arange(10)
+    chunks = [[2, 0, 3], [], [5]]
+
+    out = double_split(tensor, chunks)
+
+    assert type(out) is list
+    assert all(type(scene) is list for scene in out)
+    assert [[t.tolist() for t in scene] for scene in out] == [
+        [[0, 1], [], [2, 3, 4]],
+        [],
+        [[5, 6, 7, 8, 9]],
+    ]
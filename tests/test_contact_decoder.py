@@ -0,0 +1,175 @@
+import copy
+import pickle
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from grasp_gen.models.contact_decoder import ContactDecoder, compute_attention_mask
+from grasp_gen.models.model_utils import repeat_new_axis
+
+
+def reference_attention_mask(mask_logits, nn_ids, context_size, num_heads):
+    """Attention mask built with the original interpolate / max formulation."""
+    attn_mask = mask_logits
+    if nn_ids is None:
+        attn_mask = F.interpolate(attn_mask, context_size)
+    else:
+        j = 0
+        while attn_mask.shape[-1] != context_size:
+            attn_mask = repeat_new_axis(attn_mask, nn_ids[j].shape[-1], dim=3)
+            idx = repeat_new_axis(nn_ids[j], attn_mask.shape[1], dim=1)
+            attn_mask = torch.gather(attn_mask, dim=-2, index=idx.long())
+            attn_mask = attn_mask.max(dim=-1)[0]
+            j += 1
+    attn_mask = attn_mask < 0
+    attn_mask = repeat_new_axis(attn_mask, num_heads, dim=1).flatten(
+        start_dim=0, end_dim=1
+    )
+    attn_mask[torch.where(attn_mask.sum(-1) == attn_mask.shape[-1])] = False
+    return attn_mask
+
+
+def make_mask_logits(batch_size, num_queries, num_points):
+    logits = torch.randn(batch_size, num_queries, num_points)
+    # one query that is masked everywhere, it has to be allowed everywhere
+    logits[0, 0] = -1.0
+    return logits
+
+
+@pytest.mark.parametrize("num_points,context_size", [(37, 100), (100, 37), (64, 64)])
+def test_attention_mask_nearest_resize(num_points, context_size, random_seed):
+    """Test the index_select resize against F.interpolate plus threshold."""
+    num_heads = 4
+    logits = make_mask_logits(2, 5, num_points)
+
+    attn_mask = compute_attention_mask(logits < 0, None, context_size)
+    expected = reference_attention_mask(logits, None, context_size, num_heads)
+
+    assert attn_mask.shape == (2, 5, context_size)
+    expected = expected.view(2, num_heads, 5, context_size)
+    assert torch.equal(attn_mask, expected[:, 0])
+    assert not attn_mask[0, 0].any()
+
+
+def test_attention_mask_neighbor_downsample(random_seed):
+    """Test the neighbor gather against the repeat / max formulation."""
+    num_heads = 4
+    logits = make_mask_logits(2, 5, 128)
+    nn_ids = [
+        torch.randint(0, 128, (2, 64, 8)),
+        torch.randint(0, 64, (2, 16, 8)),
+    ]
+
+    attn_mask = compute_attention_mask(logits < 0, nn_ids, 16)
+    expected = reference_attention_mask(logits, nn_ids, 16, num_heads)
+
+    assert attn_mask.shape == (2, 5, 16)
+    assert torch.equal(attn_mask, expected.view(2, num_heads, 5, 16)[:, 0])
+    assert not attn_mask[0, 0].any()
+
+
+def make_contact_decoder(num_grasp_queries=8, num_place_queries=0):
+    decoder = ContactDecoder(
+        embed_dim=32,
+        feedforward_dim=64,
+        num_grasp_queries=num_grasp_queries,
+        num_place_queries=num_place_queries,
+        scene_in_features=["res2", "res1"],
+        scene_in_channels=[48, 24],
+        mask_feature="res0",
+        mask_dim=16,
+        place_feature="res2",
+        place_dim=32,
+        num_layers=2,
+        num_heads=4,
+        use_attn_mask=True,
+        use_task_embed=False,
+        activation="ReLU",
+        pos_enc="new",
+    )
+    return decoder.eval()
+
+
+def make_scene_features(batch_size=2):
+    sizes = {"res0": (16, 64), "res1": (24, 32), "res2": (48, 16)}
+    return {
+        "features": {
+            k: torch.randn(batch_size, c, n) for k, (c, n) in sizes.items()
+        },
+        "context_pos": {k: torch.rand(batch_size, n, 3) for k, (_, n) in sizes.items()},
+        "sample_ids": [
+            torch.randint(0, 64, (batch_size, 32, 4)),
+            torch.randint(0, 32, (batch_size, 16, 4)),
+        ],
+    }
+
+
+def assert_predictions_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert a.keys() == e.keys()
+        for key in a:
+            assert torch.allclose(a[key], e[key], atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "num_grasp_queries,num_place_queries,mode",
+    [(8, 0, "grasp"), (0, 8, "place"), (8, 8, "both")],
+)
+def test_contact_decoder_predict_mode(num_grasp_queries, num_place_queries, mode):
+    """Test that the prediction path is chosen from the query counts."""
+    decoder = make_contact_decoder(num_grasp_queries, num_place_queries)
+    assert decoder.predict_mode == mode
+
+
+def test_contact_decoder_copy_and_pickle(random_seed):
+    """Test that a decoder survives deepcopy and pickling unchanged."""
+    decoder = make_contact_decoder()
+    scene_features = make_scene_features()
+
+    with torch.no_grad():
+        _, expected = decoder(scene_features, {"features": {}})
+        for clone in [copy.deepcopy(decoder), pickle.loads(pickle.dumps(decoder))]:
+            _, predictions = clone(scene_features, {"features": {}})
+            assert_predictions_equal(predictions, expected)
+
+
+def to_conv_checkpoint(state_dict, prefix=""):
+    """State dict with the scene projections stored as 1x1 Conv2d weights."""
+    old_state_dict = {}
+    for key, val in state_dict.items():
+        if key.startswith("scene_feature_proj.") and key.endswith(".weight"):
+            val = val.view(*val.shape, 1, 1)
+        old_state_dict[prefix + key] = val.clone()
+    return old_state_dict
+
+
+def test_contact_decoder_loads_conv_checkpoint(random_seed):
+    """Test that checkpoints with the old 1x1 Conv2d projections still load."""
+    decoder = make_contact_decoder()
+    old_state_dict = to_conv_checkpoint(decoder.state_dict())
+    scene_features = make_scene_features()
+
+    loaded = make_contact_decoder()
+    loaded.load_state_dict(old_state_dict)
+    wrapped = torch.nn.ModuleDict({"contact_decoder": make_contact_decoder()})
+    wrapped.load_state_dict(
+        to_conv_checkpoint(decoder.state_dict(), prefix="contact_decoder.")
+    )
+
+    with torch.no_grad():
+        for i, f in enumerate(["res2", "res1"]):
+            context = scene_features["features"][f]
+            conv_out = F.conv2d(
+                context.unsqueeze(-1),
+                old_state_dict[f"scene_feature_proj.{i}.weight"],
+                old_state_dict[f"scene_feature_proj.{i}.bias"],
+            ).squeeze(-1)
+            linear_out = loaded.scene_feature_proj[i](context.transpose(1, 2))
+            assert torch.allclose(linear_out.transpose(1, 2), conv_out, atol=1e-5)
+
+        _, expected = decoder(scene_features, {"features": {}})
+        for model in [loaded, wrapped["contact_decoder"]]:
+            _, predictions = model(scene_features, {"features": {}})
+            assert_predictions_equal(predictions, expected)
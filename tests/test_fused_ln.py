@@ -0,0 +1,113 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+pytest.importorskip("triton")
+
+from grasp_gen.models.fused_ln import (
+    FusedLayerNorm,
+    add_layer_norm,
+    can_fuse_add_layer_norm,
+    fused_add_layer_norm,
+    layer_norm,
+)
+from grasp_gen.models.vit import Block
+
+TOLERANCES = {
+    torch.float32: 1e-5,
+    torch.float16: 1e-2,
+    torch.bfloat16: 5e-2,
+}
+
+# powers of 2 and odd widths, for the tile kernel (<= 4096) and the Welford
+# kernel (> 4096)
+TILE_WIDTHS = [64, 640, 1000, 4096]
+WELFORD_WIDTHS = [5000, 8192, 12289]
+
+
+def make_ln_inputs(num_rows, width, dtype):
+    x = torch.randn(num_rows, width, device="cuda", dtype=dtype) * 2 + 0.5
+    weight = torch.randn(width, device="cuda", dtype=dtype)
+    bias = torch.randn(width, device="cuda", dtype=dtype)
+    return x, weight, bias
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+@pytest.mark.parametrize("dtype", list(TOLERANCES))
+@pytest.mark.parametrize("width", TILE_WIDTHS + WELFORD_WIDTHS)
+def test_layer_norm_matches_torch(dtype, width, random_seed):
+    """Test the Triton LayerNorm against F.layer_norm."""
+    x, weight, bias = make_ln_inputs(37, width, dtype)
+
+    y = layer_norm(x.view(1, 37, width), weight, bias, eps=1e-6)
+    expected = F.layer_norm(x, (width,), weight, bias, eps=1e-6)
+
+    assert y.shape == (1, 37, width)
+    assert y.dtype == dtype
+    tol = TOLERANCES[dtype]
+    assert torch.allclose(y.view(37, width), expected, atol=tol, rtol=tol)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+@pytest.mark.parametrize("dtype", list(TOLERANCES))
+@pytest.mark.parametrize("width", TILE_WIDTHS)
+def test_add_layer_norm_matches_torch(dtype, width, random_seed):
+    """Test the fused residual add + LayerNorm against x + r and F.layer_norm."""
+    x, weight, bias = make_ln_inputs(37, width, dtype)
+    residual = torch.randn_like(x)
+
+    out, y = add_layer_norm(x, residual, weight, bias, eps=1e-6)
+    expected_out = x + residual
+    expected = F.layer_norm(expected_out, (width,), weight, bias, eps=1e-6)
+
+    tol = TOLERANCES[dtype]
+    assert torch.allclose(out, expected_out, atol=tol, rtol=tol)
+    assert torch.allclose(y, expected, atol=tol, rtol=tol)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+def test_add_layer_norm_rejects_wide_rows():
+    """Test that add_layer_norm refuses rows wider than the tile kernel."""
+    x, weight, bias = make_ln_inputs(4, 5000, torch.float32)
+    with pytest.raises(AssertionError):
+        add_layer_norm(x, torch.randn_like(x), weight, bias)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+@pytest.mark.parametrize("dtype", list(TOLERANCES))
+@pytest.mark.parametrize("width", [640, 1000, 5000])
+def test_fused_add_layer_norm_matches_unfused(dtype, width, random_seed):
+    """Test fused_add_layer_norm against residual + x followed by the norm."""
+    norm = FusedLayerNorm(width, eps=1e-6).to(device="cuda", dtype=dtype)
+    torch.nn.init.normal_(norm.weight)
+    torch.nn.init.normal_(norm.bias)
+    x = torch.randn(2, 37, width, device="cuda", dtype=dtype)
+    residual = torch.randn_like(x)
+
+    with torch.no_grad():
+        assert can_fuse_add_layer_norm(x, residual, norm) == (width <= 4096)
+        out, y = fused_add_layer_norm(x, residual, norm)
+        expected_out = residual + x
+        expected = F.layer_norm(
+            expected_out, (width,), norm.weight, norm.bias, eps=1e-6
+        )
+
+    tol = TOLERANCES[dtype]
+    assert torch.allclose(out, expected_out, atol=tol, rtol=tol)
+    assert torch.allclose(y, expected, atol=tol, rtol=tol)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+def test_block_with_fused_norm_matches_layer_norm(random_seed):
+    """Test a ViT block with FusedLayerNorm against the same block with nn.LayerNorm."""
+    block = Block(640, num_heads=8, qkv_bias=True).cuda().eval()
+    fused_block = Block(640, num_heads=8, qkv_bias=True, norm_layer=FusedLayerNorm)
+    fused_block.load_state_dict(block.state_dict())
+    fused_block = fused_block.cuda().eval()
+    x = torch.randn(2, 50, 640, device="cuda")
+
+    with torch.no_grad():
+        expected = block(x)
+        y = fused_block(x)
+
+    assert torch.allclose(y, expected, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,89 @@
+import math
+
+import pytest
+import torch
+
+from grasp_gen.models.model_utils import AttentionLayer, SinusoidalPosEmb
+
+
+def make_attention_inputs(L=6, S=9, B=3, C=32):
+    query = torch.randn(L, B, C)
+    key = torch.randn(S, B, C)
+    value = torch.randn(S, B, C)
+    return query, key, value
+
+
+@pytest.mark.parametrize("mask_mode", ["none", "shared", "per_head"])
+def test_multi_head_attention_matches_torch(mask_mode, random_seed):
+    """Test the SDPA attention against nn.MultiheadAttention with the same weights."""
+    layer = AttentionLayer(32, 4).eval()
+    query, key, value = make_attention_inputs()
+    L, B, S = query.shape[0], query.shape[1], key.shape[0]
+
+    attn_mask, torch_mask = None, None
+    if mask_mode != "none":
+        attn_mask = torch.rand(B, L, S) > 0.5
+        # every row keeps at least one key
+        attn_mask[..., 0] = False
+        torch_mask = attn_mask.repeat_interleave(4, dim=0)
+        if mask_mode == "per_head":
+            attn_mask = torch_mask
+
+    with torch.no_grad():
+        output = layer.multi_head_attention(query, key, value, attn_mask=attn_mask)
+        expected, _ = layer.attn(query, key, value, attn_mask=torch_mask)
+
+    assert output.shape == (L, B, 32)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_multi_head_attention_fully_masked_rows(random_seed):
+    """Test that fully masked query rows do not affect the other rows."""
+    layer = AttentionLayer(32, 4).eval()
+    query, key, value = make_attention_inputs()
+    L, B, S = query.shape[0], query.shape[1], key.shape[0]
+    attn_mask = torch.rand(B, L, S) > 0.5
+    attn_mask[..., 0] = False
+    attn_mask[0, 2] = True
+    attn_mask[2, 0] = True
+
+    with torch.no_grad():
+        output = layer.multi_head_attention(query, key, value, attn_mask=attn_mask)
+        expected, _ = layer.attn(
+            query, key, value, attn_mask=attn_mask.repeat_interleave(4, dim=0)
+        )
+
+    # Fully masked rows come out as NaN or zeros depending on the torch version
+    # and SDPA backend (the contact decoder never builds them), only the other
+    # rows are defined.
+    kept = ~attn_mask.all(dim=-1).T
+    assert kept.sum() == L * B - 2
+    assert torch.isfinite(output[kept]).all()
+    assert torch.allclose(output[kept], expected[kept], atol=1e-5)
+
+
+def reference_sinusoidal_pos_emb(x, dim):
+    half_dim = dim // 2
+    emb = math.log(10000) / (half_dim - 1)
+    emb = torch.exp(torch.arange(half_dim, device=x.device) * -emb)
+    emb = x[:, None] * emb[None, :]
+    return torch.cat((emb.sin(), emb.cos()), dim=-1)
+
+
+def test_sinusoidal_pos_emb_matches_reference():
+    """Test the precomputed frequencies against computing them per call."""
+    x = torch.arange(0, 1000, 37).float()
+    emb = SinusoidalPosEmb(64)(x)
+    assert torch.allclose(emb, reference_sinusoidal_pos_emb(x, 64), atol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_sinusoidal_pos_emb_keeps_fp32_freqs(dtype):
+    """Test that casting the module keeps its frequencies and output in fp32."""
+    x = torch.arange(0, 1000, 37).to(dtype)
+    module = SinusoidalPosEmb(64).to(dtype)
+
+    assert module.freqs.dtype == torch.float32
+    emb = module(x)
+    assert emb.dtype == torch.float32
+    assert torch.equal(emb, reference_sinusoidal_pos_emb(x, 64))
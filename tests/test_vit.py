@@ -0,0 +1,256 @@
+import pytest
+import torch
+
+from grasp_gen.models.vit import (
+    SinusoidalPosEmb,
+    VisionTransformer,
+    checkpoint_filter_fn,
+    compile_vit,
+    load_checkpoint_safetensors,
+)
+
+
+def make_vit(**kwargs):
+    args = dict(
+        img_size=32,
+        patch_size=8,
+        embed_dim=64,
+        depth=2,
+        num_heads=4,
+        num_classes=10,
+    )
+    args.update(kwargs)
+    return VisionTransformer(**args).eval()
+
+
+def test_pos_embed_inference_matches_concat(random_seed):
+    """Test the inference position embedding against the autograd concat path."""
+    model = make_vit(reg_tokens=2)
+    x = torch.randn(3, 16, 64)
+
+    with torch.no_grad():
+        y = model._pos_embed(x)
+    with torch.enable_grad():
+        expected = model._pos_embed(x)
+
+    assert torch.allclose(y, expected.detach(), atol=1e-6)
+
+
+def test_pos_embed_outputs_are_not_reused(random_seed):
+    """Test that a later call does not overwrite the output of an earlier one."""
+    model = make_vit()
+    x1, x2 = torch.randn(2, 16, 64), torch.randn(2, 16, 64)
+
+    with torch.no_grad():
+        y1 = model._pos_embed(x1)
+        y1_copy = y1.clone()
+        y2 = model._pos_embed(x2)
+
+    assert y1.data_ptr() != y2.data_ptr()
+    assert torch.equal(y1, y1_copy)
+
+
+def test_pos_embed_follows_loaded_weights(random_seed):
+    """Test that prefix tokens reflect parameters loaded after a first call."""
+    model = make_vit()
+    other = make_vit()
+    x = torch.randn(2, 16, 64)
+
+    with torch.no_grad():
+        model._pos_embed(x)
+        model.load_state_dict(other.state_dict())
+        y = model._pos_embed(x)
+        expected = other._pos_embed(x)
+
+    assert torch.allclose(y, expected, atol=1e-6)
+
+
+def test_sinusoidal_pos_emb_keeps_fp32_freqs():
+    """Test that casting the module keeps its frequencies in fp32."""
+    module = SinusoidalPosEmb(64).half()
+    assert module.freqs.dtype == torch.float32
+
+
+def test_compile_vit_rejects_triton_norm():
+    """Test that compile_vit refuses models with the Triton LayerNorm."""
+    with pytest.raises(ValueError):
+        compile_vit(make_vit(norm_impl="triton"))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+def test_compile_vit_matches_eager(random_seed):
+    """Test that the compiled ViT forward matches the eager one."""
+    model = make_vit().cuda()
+    compiled = make_vit().cuda()
+    compiled.load_state_dict(model.state_dict())
+    compiled = compile_vit(compiled)
+    x = torch.randn(2, 3, 32, 32, 3, device="cuda")
+
+    with torch.no_grad():
+        expected = model(x)
+        for _ in range(3):
+            # the first calls record the CUDA graph, later ones replay it
+            y = compiled(x)
+            assert torch.allclose(y, expected, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA required")
+def test_compile_vit_intermediate_layers(random_seed):
+    """Test the compiled block loop of get_intermediate_layers against eager."""
+    model = make_vit().cuda()
+    compiled = make_vit().cuda()
+    compiled.load_state_dict(model.state_dict())
+    compiled = compile_vit(compiled)
+    x = torch.randn(2, 3, 32, 32, device="cuda")
+
+    with torch.no_grad():
+        for n in [[0], 2, [0]]:
+            expected = model.get_intermediate_layers(x, n=n)
+            outputs = compiled.get_intermediate_layers(x, n=n)
+            assert len(outputs) == len(expected)
+            for y, e in zip(outputs, expected):
+                assert torch.allclose(y, e, atol=1e-4, rtol=1e-4)
+
+
+def test_checkpoint_filter_keeps_input(random_seed):
+    """Test that filtering leaves the caller's checkpoint unchanged by default."""
+    model = make_vit()
+    state_dict = {"encoder": {f"module.{k}": v for k, v in model.state_dict().items()}}
+    keys = list(state_dict["encoder"])
+
+    out = checkpoint_filter_fn(state_dict, model)
+    out_again = checkpoint_filter_fn(state_dict, model)
+
+    assert list(state_dict) == ["encoder"]
+    assert list(state_dict["encoder"]) == keys
+    assert out.keys() == out_again.keys() == model.state_dict().keys()
+    model.load_state_dict(out)
+
+
+def test_checkpoint_filter_inplace(random_seed):
+    """Test that inplace filtering converts and returns the caller's dict."""
+    model = make_vit()
+    state_dict = {f"module.{k}": v for k, v in model.state_dict().items()}
+
+    out = checkpoint_filter_fn({"encoder": state_dict}, model, inplace=True)
+
+    assert out is state_dict
+    model.load_state_dict(out)
+
+
+def to_dinov2_checkpoint(state_dict):
+    """State dict with the block mlp and mask token named as in dinov2."""
+    out = {"mask_token": torch.zeros(1, 64)}
+    for k, v in state_dict.items():
+        k = k.replace(".mlp.fc1.", ".mlp.w12.").replace(".mlp.fc2.", ".mlp.w3.")
+        out[k] = v
+    return out
+
+
+def to_openai_clip_checkpoint(state_dict):
+    """State dict of the vision tower named as in OpenAI CLIP, with text keys."""
+    swaps = [
+        ("blocks.", "transformer.resblocks."),
+        ("norm1", "ln_1"),
+        ("norm2", "ln_2"),
+        ("attn.qkv.", "attn.in_proj_"),
+        ("attn.proj.", "attn.out_proj."),
+        ("mlp.fc1", "mlp.c_fc"),
+        ("mlp.fc2", "mlp.c_proj"),
+        ("patch_embed.proj", "conv1"),
+        ("norm_pre", "ln_pre"),
+    ]
+    out = {
+        "logit_scale": torch.ones([]),
+        "token_embedding.weight": torch.randn(8, 64),
+        "transformer.resblocks.0.ln_1.weight": torch.ones(64),
+    }
+    for k, v in state_dict.items():
+        if k == "cls_token":
+            k, v = "class_embedding", v[0, 0]
+        elif k == "pos_embed":
+            k, v = "positional_embedding", v[0]
+        elif k == "head.weight":
+            k, v = "proj", v.t()
+        elif k == "head.bias":
+            continue
+        elif k.startswith("norm."):
+            k = "ln_post." + k.removeprefix("norm.")
+        for old, new in swaps:
+            k = k.replace(old, new)
+        out["visual." + k] = v
+    return out
+
+
+def test_checkpoint_filter_dinov2_keys(random_seed):
+    """Test the dinov2 key mapping, keys already in timm naming are kept."""
+    model = make_vit(init_values=1e-5)
+    expected = model.state_dict()
+
+    out = checkpoint_filter_fn(to_dinov2_checkpoint(expected), model)
+
+    assert out.keys() == expected.keys()
+    for k, v in out.items():
+        assert v is expected[k]
+
+
+def test_checkpoint_filter_openai_clip_keys(random_seed):
+    """Test the OpenAI CLIP key mapping, the text tower keys are dropped."""
+    model = make_vit(pre_norm=True)
+    expected = model.state_dict()
+
+    out = checkpoint_filter_fn(to_openai_clip_checkpoint(expected), model)
+
+    assert out.keys() == expected.keys()
+    for k, v in out.items():
+        if k == "head.bias":
+            assert not v.any()
+        else:
+            assert torch.equal(v, expected[k])
+
+
+def test_load_checkpoint_safetensors(tmp_path, random_seed):
+    """Test loading a dinov2 .safetensors checkpoint tensor by tensor."""
+    safetensors_torch = pytest.importorskip("safetensors.torch")
+    model = make_vit(init_values=1e-5)
+    other = make_vit(init_values=1e-5)
+    state_dict = {k: v.clone() for k, v in other.state_dict().items()}
+    path = str(tmp_path / "vit.safetensors")
+    safetensors_torch.save_file(to_dinov2_checkpoint(state_dict), path)
+
+    missing_keys, unexpected_keys = load_checkpoint_safetensors(path, model)
+
+    assert missing_keys == [] and unexpected_keys == []
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, state_dict[k])
+
+
+def test_load_pretrained_torch_checkpoint(tmp_path, random_seed):
+    """Test loading a torch checkpoint through checkpoint_filter_fn."""
+    model = make_vit()
+    other = make_vit()
+    path = str(tmp_path / "vit.pth")
+    torch.save({"model": other.state_dict()}, path)
+
+    model.load_pretrained(path)
+
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, other.state_dict()[k])
+
+
+def test_load_checkpoint_safetensors_size_mismatch(tmp_path, random_seed):
+    """Test that a shape mismatch is raised before any tensor is copied."""
+    safetensors_torch = pytest.importorskip("safetensors.torch")
+    model = make_vit()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    other = make_vit(num_classes=5)
+    path = str(tmp_path / "vit.safetensors")
+    safetensors_torch.save_file(
+        {k: v.clone() for k, v in other.state_dict().items()}, path
+    )
+
+    with pytest.raises(RuntimeError, match="head.weight"):
+        load_checkpoint_safetensors(path, model)
+
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, expected[k])